@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+
+"""
+Per-record CPU cost of turning a log record into a message body.
+run: python -m benchmarks.bench_projection
+"""
+
+import json
+import time
+import logging
+import timeit
+from handler.utils import DEFAULT_FORMAT, FMT_ASCTIME, FMT_CREATED, FMT_MESSAGE, RecordProjector, get_serializer
+
+
+def copy_dumps(record, fields=DEFAULT_FORMAT):
+    """projection of handlers before RecordProjector"""
+    log_data = dict()
+    origin_data = record.__dict__.copy()
+    origin_data[FMT_ASCTIME] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(origin_data.get(FMT_CREATED)))
+    origin_data[FMT_MESSAGE] = origin_data.get("msg")
+    for field in fields:
+        log_data[field] = origin_data.get(field)
+    return json.dumps(log_data, ensure_ascii=False).encode("utf-8")
+
+
+def main(number=100000):
+    record = logging.LogRecord("bench", logging.INFO, __file__, 1, {"user": "abc", "action": "login"}, None, None)
+    projector = RecordProjector(DEFAULT_FORMAT)
+    cases = [("dict copy + json", lambda: copy_dumps(record))]
+    for name in ("json", "orjson", "msgpack"):
+        try:
+            dumps, _ = get_serializer(name)
+        except ImportError:
+            continue
+        cases.append(("projector + {0}".format(name), lambda dumps=dumps: dumps(projector.project(record))))
+    for name, func in cases:
+        cost = timeit.timeit(func, number=number) / number
+        print("{0:<24} {1:.2f} us/record".format(name, cost * 1e6))
+
+
+if __name__ == "__main__":
+    main()
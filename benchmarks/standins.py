@@ -0,0 +1,135 @@
+# -*- coding:utf-8 -*-
+
+"""
+In-process stand-ins of rabbitmq transport, so handlers can be benchmarked offline.
+patch_transport replaces pika.BlockingConnection and aiormq.connect, published messages and logs in them are only
+counted.
+"""
+
+import time
+import pika
+import aiormq
+import asyncio
+import threading
+import contextlib
+from types import SimpleNamespace
+from handler.batch import HEADER_COUNT
+
+
+class TransportStats(object):
+    def __init__(self):
+        self.connections = 0
+        self.messages = 0
+        self.logs = 0
+        self.bytes = 0
+        self.lock = threading.Lock()    # pooled channels publish from several threads
+
+    def add(self, body: bytes, properties=None):
+        """count a published message, a message batch contains the number of logs of its header"""
+        headers = getattr(properties, "headers", None) or {}
+        with self.lock:
+            self.messages += 1
+            self.logs += headers.get(HEADER_COUNT, 1)
+            self.bytes += len(body)
+
+
+class FakeChannel(object):
+    def __init__(self, stats: TransportStats, latency: float):
+        self.stats = stats
+        self.latency = latency
+        self.is_closed = False
+        self.delivery_tag = 0
+        self.acked_tag = 0
+        self.ack_nack_callback = None
+        self._impl = self
+
+    def exchange_declare(self, **kwargs):
+        pass
+
+    def confirm_delivery(self, ack_nack_callback=None, **kwargs):
+        self.ack_nack_callback = ack_nack_callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.stats.add(body, properties)
+        self.delivery_tag += 1
+
+    def ack(self):
+        """broker acks all published messages at once"""
+        if self.ack_nack_callback is not None and self.delivery_tag > self.acked_tag:
+            self.acked_tag = self.delivery_tag
+            method = pika.spec.Basic.Ack(delivery_tag=self.delivery_tag, multiple=True)
+            self.ack_nack_callback(SimpleNamespace(method=method))
+
+    def close(self):
+        self.is_closed = True
+
+
+class FakeBlockingConnection(object):
+    stats = None
+    latency = 0
+
+    def __init__(self, parameters=None):
+        self.stats.connections += 1
+        self.is_closed = False
+        self.channels = []
+
+    def channel(self):
+        channel = FakeChannel(self.stats, self.latency)
+        self.channels.append(channel)
+        return channel
+
+    def process_data_events(self, time_limit=0):
+        for channel in self.channels:
+            channel.ack()
+
+    def close(self):
+        self.is_closed = True
+
+
+class FakeAioChannel(object):
+    def __init__(self, stats: TransportStats, latency: float):
+        self.stats = stats
+        self.latency = latency
+
+    async def exchange_declare(self, **kwargs):
+        pass
+
+    async def basic_publish(self, body, exchange="", routing_key="", properties=None, **kwargs):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        self.stats.add(body, properties)
+
+
+class FakeAioConnection(object):
+    def __init__(self, stats: TransportStats, latency: float):
+        self.stats = stats
+        self.latency = latency
+
+    async def channel(self, **kwargs):
+        return FakeAioChannel(self.stats, self.latency)
+
+    async def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def patch_transport(latency: float = 0):
+    """
+    replace transport of pika and aiormq, yield TransportStats of published messages
+    :param latency: seconds of publishing one message
+    """
+    stats = TransportStats()
+
+    async def connect(url, *args, **kwargs):
+        stats.connections += 1
+        return FakeAioConnection(stats, latency)
+
+    connection_class = type("FakeBlockingConnection", (FakeBlockingConnection,), dict(stats=stats, latency=latency))
+    origin = pika.BlockingConnection, aiormq.connect
+    pika.BlockingConnection, aiormq.connect = connection_class, connect
+    try:
+        yield stats
+    finally:
+        pika.BlockingConnection, aiormq.connect = origin
@@ -0,0 +1,26 @@
+# -*- coding:utf-8 -*-
+
+"""
+Python log handlers emit log to rabbitmq or sql database.
+Handler modules are imported when they are used, eg: handler.MySQLHandler only imports sqlalchemy.
+"""
+
+import importlib
+
+_HANDLER_MODULES = {
+    "RabbitmqHandler": "rabbitmq",
+    "AioRabbitmqHandler": "aiorabbitmq",
+    "MySQLHandler": "mysql",
+    "AioMySQLHandler": "aiomysql",
+    "CollectorHandler": "collector",
+    "FanoutHandler": "fanout",
+}
+
+__all__ = list(_HANDLER_MODULES)
+
+
+def __getattr__(name):
+    module = _HANDLER_MODULES.get(name)
+    if module is None:
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+    return getattr(importlib.import_module("." + module, __name__), name)
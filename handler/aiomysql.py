@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+This is an asyncio logging handler of mysql.
+emit only puts record into a bounded queue, a drain task serializes records and inserts them by batches.
+Inserts run in a dedicated thread by the engine of MySQLHandler, so database never blocks the event loop.
+"""
+
+import sys
+import time
+import asyncio
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from .utils import OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST
+from .mysql import MySQLHandler
+
+
+class AioMySQLHandler(MySQLHandler):
+    def __init__(self, uri, table_name, level=logging.NOTSET, origin_field=None, new_field=None, batch_size=100,
+                 datefmt=None, asctime_msecs=False, spool_path=None, spool_max_size=1024 * 1024 * 1024,
+                 circuit_breaker=None, reflect=False, queue_size=10000, overflow=OVERFLOW_DROP_NEWEST,
+                 priority_level=None, partition=None, indexes=None, retention=None, purge_interval=3600):
+        """
+        asyncio mysql log handler, table schema and params are the same as MySQLHandler.
+        :param batch_size:     int  max rows inserted by one multi-row INSERT, the drain task takes all queued
+                                    records up to batch_size at once.
+        :param queue_size:     int  max records waiting in queue.
+        :param overflow:       str  what to do when queue is full, 'drop_oldest' drops the oldest record in queue,
+                                    'drop_newest' drops the record being emitted. emit can't wait in event loop,
+                                    so 'block' isn't supported.
+        :param priority_level: int  records with levelno >= priority_level (eg: logging.ERROR) bypass queue, each
+                                    one is inserted by its own task at once.
+        """
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError("overflow should be one of {0}".format((OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)))
+        # rows are written by one thread in order, spool replayer and purger may use other connections
+        super(AioMySQLHandler, self).__init__(
+            uri, table_name, level=level, origin_field=origin_field, new_field=new_field, datefmt=datefmt,
+            asctime_msecs=asctime_msecs, spool_path=spool_path, spool_max_size=spool_max_size,
+            circuit_breaker=circuit_breaker, reflect=reflect, pool_size=1, max_overflow=2,
+            priority_level=priority_level, partition=partition, indexes=indexes, retention=retention,
+            purge_interval=purge_interval)
+        self.batch_size = max(int(batch_size), 1)
+        self.queue_size = max(int(queue_size), 1)
+        self.overflow = overflow
+        self.dropped_oldest = 0
+        self.priority_tasks = set()
+        self.dropped_priority = 0
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="AioMySQLHandler-writer")
+        # queue and drain task are created in event loop by the first emit
+        self.loop = None
+        self.queue = None
+        self.consumer = None
+
+    def start(self):
+        """create queue and drain task in current event loop"""
+        self.loop = asyncio.get_event_loop()
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.consumer = self.loop.create_task(self.consume())
+
+    def serialize_rows(self, records):
+        rows = []
+        for record in records:
+            try:
+                rows.append(self.serialize(record))
+            except Exception:
+                self.handleError(record)
+        return rows
+
+    async def write(self, records):
+        """serialize records and insert rows in writer thread"""
+        rows = self.serialize_rows(records)
+        if rows:
+            await self.loop.run_in_executor(self.executor, self.write_rows, rows)
+
+    async def consume(self):
+        """the only task taking records from queue, a batch of records is inserted by one INSERT"""
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await self.write(batch)
+            except Exception:
+                msg = "{0} - [sql] Write {1} log rows failed.\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), len(batch))
+                sys.stdout.write(msg)
+                traceback.print_exc(file=sys.stdout)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def emit_priority(self, record):
+        if len(self.priority_tasks) >= self.queue_size:
+            self.dropped_priority += 1
+            return
+        task = self.loop.create_task(self.write([record]))
+        self.priority_tasks.add(task)
+        task.add_done_callback(self.priority_tasks.discard)
+
+    def emit(self, record):
+        self.metrics.emitted += 1
+        try:
+            if self.consumer is None or self.consumer.done():
+                self.start()
+            if self.priority_level is not None and record.levelno >= self.priority_level:
+                self.emit_priority(record)
+                return
+            if self.queue.full():
+                if self.overflow == OVERFLOW_DROP_OLDEST:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped_oldest += 1
+                else:
+                    self.dropped_newest += 1
+                    return
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+            traceback.print_exc()
+
+    def _stats_items(self):
+        dropped, gauges = super(AioMySQLHandler, self)._stats_items()
+        dropped["queue_full_oldest"] = self.dropped_oldest
+        dropped["priority_lane_full"] = self.dropped_priority
+        gauges["queue_depth"] = self.queue.qsize() if self.queue is not None else 0
+        gauges["priority_writing"] = len(self.priority_tasks)
+        return dropped, gauges
+
+    async def aflush(self):
+        """wait until all queued records are inserted"""
+        if self.priority_tasks:
+            await asyncio.gather(*list(self.priority_tasks))
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def aclose(self):
+        """insert queued records, stop drain task, then close handler in writer thread"""
+        await self.aflush()
+        if self.consumer is not None:
+            self.consumer.cancel()
+            try:
+                await self.consumer
+            except asyncio.CancelledError:
+                pass
+            self.consumer = None
+        await asyncio.get_event_loop().run_in_executor(self.executor, self.close)
+        self.executor.shutdown()
@@ -6,22 +6,48 @@ asynchronous connect to rabbitmq and send log.
 """
 
 import sys
-import json
 import time
 import asyncio
 import aiormq
 import logging
 import traceback
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from .utils import (
     DEFAULT_EXCHANGE,
     DEFAULT_FORMAT,
     LOGGING_FORMAT_NAME,
     FMT_MESSAGE,
-    FMT_ASCTIME,
-    FMT_CREATED,
-    LogOriginFieldError
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_DROP_NEWEST,
+    LogOriginFieldError,
+    RecordProjector,
+    RoutingKeyPlanner,
+    get_serializer,
+    get_asctime_formatter,
+    CircuitBreaker,
+    ConsistentHashRing
 )
+from .spool import DiskSpool, pack_message, unpack_message
+from .batch import MessageBatcher, check_compression, encode_batch
+from .metrics import HandlerMetrics
+
+
+class AioShard(object):
+    def __init__(self, index: int, circuit_breaker: dict = None):
+        """
+        One connection and channel of AioRabbitmqHandler, every shard reconnects and opens circuit by itself.
+        """
+        self.index = index
+        self.connection = None
+        self.channel = None
+        self.is_closed = True
+        self.has_connected = False      # the first connection isn't counted as reconnect
+        # lock, queue of (routing, bodies) and the task sending them are created in event loop
+        self.connect_lock = None
+        self.queue = None
+        self.sender = None
+        self.breaker = CircuitBreaker(**(circuit_breaker or {}))
 
 
 class AioRabbitmqHandler(logging.Handler):
@@ -32,7 +58,25 @@ class AioRabbitmqHandler(logging.Handler):
             exchange: str = DEFAULT_EXCHANGE,
             fields: list = None,
             level=logging.NOTSET,
-            routing_key: list = None
+            routing_key: list = None,
+            serializer: str = None,
+            datefmt: str = None,
+            asctime_msecs: bool = False,
+            queue_size: int = 10000,
+            batch_size: int = 100,
+            overflow: str = OVERFLOW_DROP_NEWEST,
+            spool_path: str = None,
+            spool_max_size: int = 1024 * 1024 * 1024,
+            circuit_breaker: dict = None,
+            message_batch_size: int = 1,
+            message_batch_window: float = 1.0,
+            compression: str = None,
+            publisher_confirms: bool = True,
+            confirm_window: int = 1000,
+            confirm_timeout: float = 30.0,
+            confirm_retries: int = 2,
+            shards: int = 1,
+            priority_level: int = None
     ):
         """
         Rabbitmq Handler emit log to rabbitmq
@@ -46,8 +90,40 @@ class AioRabbitmqHandler(logging.Handler):
         format string fields of defined by logging or fields of message where message is dict.
         If fields is not in log data, will use "*" replace. If element of routing_key is fields of message,
         should use dot separate, eg: 'message.field1.fields2', 'message.field1'.
+        :param serializer: 'json', 'orjson' or 'msgpack', content_type of message is set by serializer.
+        If param is None, use orjson when it is installed, otherwise json.
+        :param datefmt: time.strftime format of 'asctime' field, or 'iso8601'. Default is '%Y-%m-%d %H:%M:%S'.
+        :param asctime_msecs: whether 'asctime' field contains milliseconds.
+        :param queue_size: max size of queue, emit puts record into queue and one consumer task publishes them.
+        :param batch_size: max records taken from queue and published together by consumer task.
+        :param overflow: what to do when queue is full, 'drop_oldest' drops the oldest record in queue,
+        'drop_newest' drops the record being emitted. emit can't wait in event loop, so 'block' isn't supported.
+        :param spool_path: directory of disk spool. If it is set, logs that can't be published are appended to
+        spool instead of retrying, and a replay task publishes them in order after connection recovers.
+        :param spool_max_size: max bytes of disk spool.
+        :param circuit_breaker: kwargs of CircuitBreaker, eg: {"failure_threshold": 3, "probe_interval": 1}.
+        While circuit is open, logs are appended to spool, or dropped if spool_path isn't set.
+        :param message_batch_size: if > 1, logs with same routing key are packed into one message (NDJSON, or
+        msgpack stream with serializer msgpack) of at most message_batch_size logs.
+        Consumers can unpack messages by handler.batch.decode_batch.
+        :param message_batch_window: max seconds a log waits for its message batch.
+        :param compression: compression of message batch, None, 'gzip' or 'zstd'.
+        :param publisher_confirms: enable publisher confirms, messages are published concurrently and at most
+        confirm_window messages wait for ack. Default is True like the aiormq channel, every message waits for
+        its ack. Set False to publish without delivery guarantee (default of RabbitmqHandler).
+        :param confirm_window: max unconfirmed messages.
+        :param confirm_timeout: seconds to wait for ack, message is published again after timeout.
+        :param confirm_retries: times to publish again a nacked or timed out message, after that it is appended
+        to spool, or dropped if spool_path isn't set.
+        :param shards: number of connections, logs are distributed to them by consistent hash of routing key, so
+        logs with same routing key are published by the same connection in order. Every shard has its own queue
+        and task, a slow shard doesn't delay the others.
+        :param priority_level: records with levelno >= priority_level (eg: logging.ERROR) bypass queue and message
+        batching, each one is published by its own task at once and waits for confirm, so they are never dropped
+        by a full queue of lower records. At most queue_size priority records are being published.
         """
         super(AioRabbitmqHandler, self).__init__(level)
+        self.metrics = HandlerMetrics(self)
         if len(appname) > 100:
             raise ValueError("application name is to long")
         self.appname = appname
@@ -69,22 +145,70 @@ class AioRabbitmqHandler(logging.Handler):
         if FMT_MESSAGE in routing_key:
             raise ValueError("message fild cat as routing key")
         self.routing_key = routing_key
+        self.asctime_formatter = get_asctime_formatter(datefmt, asctime_msecs)
+        self.projector = RecordProjector(self.origin_fields, self.asctime_formatter)
+        self.routing_planner = RoutingKeyPlanner(appname, routing_key, asctime_formatter=self.asctime_formatter)
+        self.dumps, self.content_type = get_serializer(serializer)
 
-        self.connection = None
-        self.channel = None
+        self.shards = [AioShard(index, circuit_breaker) for index in range(max(int(shards), 1))]
+        self.shard_ring = ConsistentHashRing(len(self.shards))
 
         self.is_exchange_declared = False
-        self.is_closed = True
-        self.init_connection = asyncio.Queue(maxsize=1)
         self.loop = None
+        self.publish_failed = 0
+
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError("overflow should be one of {0}".format((OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)))
+        self.queue_size = max(int(queue_size), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.overflow = overflow
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.priority_level = priority_level
+        self.priority_tasks = set()
+        self.dropped_priority = 0
+        # queue, locks and consumer task are created in event loop by the first emit
+        self.queue = None
+        self.consumer = None
+
+        self.message_batcher = None
+        self.compression = compression
+        self.publisher_confirms = publisher_confirms
+        self.confirm_window = max(int(confirm_window), 1)
+        self.confirm_timeout = confirm_timeout
+        self.confirm_retries = confirm_retries
+        self.confirm_semaphore = None
+        if message_batch_size > 1:
+            check_compression(compression)
+            self.message_batcher = MessageBatcher(message_batch_size, message_batch_window)
 
-    async def connect(self):
-        self.connection = await aiormq.connect(self.uri)
-        self.channel = await self.connection.channel()
-        msg = '{0} - [rabbitmq] Connect to {1} success.\n'.format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), self.uri)
+        self.spool = DiskSpool(spool_path, max_size=spool_max_size) if spool_path else None
+        # spool reads and writes files (with fsync) in one thread out of event loop, in the order they are called
+        self.spool_executor = None
+        if self.spool is not None:
+            self.spool_executor = ThreadPoolExecutor(1, thread_name_prefix="AioRabbitmqHandler-spool")
+        # state of spool kept in event loop, so send checks it without waiting for spool thread.
+        # has_spooled is cleared by replay when it reads nothing and no log is appended meanwhile
+        self.has_spooled = self.spool is not None and not self.spool.is_empty()
+        self.spool_appends = 0
+        self.spool_failed = 0
+        self.replayer = None
+        self.replay_interval = 1.0
+        self.max_replay_interval = 30.0
+        self.max_replay_nacks = 3   # a log of spool nacked so many times is dropped
+        self.replay_nacked = 0
+
+    async def connect(self, shard: AioShard):
+        if shard.has_connected:
+            self.metrics.reconnects += 1
+        shard.has_connected = True
+        shard.connection = await aiormq.connect(self.uri)
+        shard.channel = await shard.connection.channel(publisher_confirms=self.publisher_confirms)
+        msg = '{0} - [rabbitmq] Connect to {1} success, shard {2}.\n'.format(
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"), self.uri, shard.index)
         sys.stdout.write(msg)
         if self.is_exchange_declared is False:
-            await self.channel.exchange_declare(
+            await shard.channel.exchange_declare(
                 exchange=self.exchange,
                 exchange_type="topic",
                 passive=False,
@@ -93,89 +217,390 @@ class AioRabbitmqHandler(logging.Handler):
             )
             self.is_exchange_declared = True
 
-    async def rabbit_connect(self):
-        if self.is_closed:
-            await self.init_connection.put(1)
-            if self.is_closed:
-                await self.connect()
-                self.is_closed = False
-        if not self.init_connection.empty():
-            try:
-                self.init_connection.get_nowait()
-            except asyncio.QueueEmpty:
-                pass
+    async def rabbit_connect(self, shard: AioShard):
+        async with shard.connect_lock:
+            if shard.is_closed:
+                await self.connect(shard)
+                shard.is_closed = False
 
     def get_routing_key(self, data: dict):
-        origin_data = data
-        routing = self.appname + "."
-        for field in self.routing_key:
-            value = None
-            keys = field.split(".")
-            data = origin_data
-            for index, key in enumerate(keys):
-                value = data.get(key)
-                data = value
-                if not isinstance(data, dict):
-                    if index == len(keys) - 1 and value is not None:
-                        value = str(value)
-                    break
-            if not isinstance(value, str):
-                value = "*"
-            routing += str(value) + "."
-        routing = routing[:-1]
-        if len(self.appname) < 255 < len(routing):
-            routing = self.appname + ".*" * len(self.routing_key)
-        if len(routing) > 255:
-            routing = routing[:255]
-        return routing
-
-    async def _emit(self, record):
-        log_data = dict()
-        origin_data = record.__dict__.copy()
-        origin_data[FMT_ASCTIME] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(origin_data.get(FMT_CREATED)))
-        origin_data[FMT_MESSAGE] = origin_data.get("msg")
-        for field in self.origin_fields:
-            log_data[field] = origin_data.get(field)
-        routing = self.get_routing_key(origin_data)
-        await self.channel.basic_publish(
+        return self.routing_planner.get_routing_key(data)
+
+    def get_shard(self, routing: str):
+        return self.shards[self.shard_ring.get(routing)]
+
+    async def basic_publish(self, channel, routing: str, body: bytes, content_type: str = None, headers: dict = None,
+                            content_encoding: str = None):
+        await channel.basic_publish(
             exchange=self.exchange,
             routing_key=routing,
-            body=json.dumps(log_data, ensure_ascii=False).encode("utf-8"),
-            properties=aiormq.spec.Basic.Properties(delivery_mode=2)
+            body=body,
+            properties=aiormq.spec.Basic.Properties(
+                delivery_mode=2,
+                content_type=content_type or self.content_type,
+                headers=headers,
+                content_encoding=content_encoding
+            )
         )
 
-    async def con_close(self):
+    def build_message(self, record):
+        """return (routing key, serialized log)"""
+        return self.routing_planner.get_record_routing_key(record), self.dumps(self.projector.project(record))
+
+    async def con_close(self, shard: AioShard):
         try:
-            if self.connection:
-                await self.connection.close()
+            if shard.connection:
+                await shard.connection.close()
         finally:
-            self.connection = None
-            self.channel = None
+            shard.connection = None
+            shard.channel = None
+            shard.is_closed = True
+
+    async def confirm_publish(self, channel, routing: str, message: tuple):
+        """publish message and wait for its ack, nacked or timed out message is published again"""
+        for attempt in range(self.confirm_retries + 1):
+            try:
+                async with self.confirm_semaphore:
+                    await asyncio.wait_for(self.basic_publish(channel, routing, *message), self.confirm_timeout)
+                return
+            except (aiormq.exceptions.DeliveryError, asyncio.TimeoutError):
+                if attempt >= self.confirm_retries:
+                    raise
+                self.metrics.retried += 1
+
+    async def publish_bodies(self, shard: AioShard, routing: str, bodies: list):
+        """publish serialized logs, messages are pipelined when publisher confirms is enabled"""
+        if self.message_batcher is not None:
+            messages = [encode_batch(bodies, self.content_type, self.compression)]
+        else:
+            messages = [(body,) for body in bodies]
+        if not self.publisher_confirms:
+            for message in messages:
+                await self.basic_publish(shard.channel, routing, *message)
+            return
+        await asyncio.gather(*[self.confirm_publish(shard.channel, routing, message) for message in messages])
 
-    async def base_publish(self, record):
+    async def base_publish(self, shard: AioShard, routing: str, bodies: list):
+        """publish by shard whose breaker allowed the request, record the outcome, raise if publishing fails"""
         try:
-            if self.is_closed is True:
-                await self.rabbit_connect()
-            await self._emit(record)
-            return True
+            if shard.is_closed is True:
+                await self.rabbit_connect(shard)
+            start = time.perf_counter()
+            await self.publish_bodies(shard, routing, bodies)
+            self.metrics.publish_seconds.observe(time.perf_counter() - start)
+            self.metrics.batch_size.observe(len(bodies))
+        except aiormq.exceptions.DeliveryError:  # nacked after retries, connection is still fine
+            shard.breaker.record_success()
+            raise
         except Exception as e:
+            shard.breaker.record_failure()
             sys.stdout.write("publish log error, maybe connection closed:{0}\n".format(e))
             traceback.print_exc()
-            await self.con_close()
-            self.is_closed = True
-            return False
+            await self.con_close(shard)
+            raise
+        shard.breaker.record_success()
+
+    async def send(self, routing: str, bodies: list):
+        """publish serialized logs, they are packed into one message in message batching mode"""
+        if self.has_spooled:
+            # logs in spool are sent first, so keep order by spooling these too
+            await self.spool_bodies(routing, bodies)
+            return
+        shard = self.get_shard(routing)
+        count = 1 if self.spool is not None else 2
+        while count > 0 and shard.breaker.allow_request():  # fail fast while rabbitmq is unavailable
+            try:
+                await self.base_publish(shard, routing, bodies)
+                return
+            except aiormq.exceptions.DeliveryError as e:
+                # confirm_publish has published it confirm_retries times, don't publish it again
+                sys.stdout.write("publish log error, message is nacked:{0}\n".format(e))
+                break
+            except Exception:
+                count -= 1
+                if count > 0:  # maybe connection is closed, publish again
+                    self.metrics.retried += 1
+        await self.fallback(routing, bodies)
+
+    async def fallback(self, routing: str, bodies: list):
+        """logs can't be published are appended to spool, or dropped if spool_path isn't set"""
+        if self.spool is not None:
+            await self.spool_bodies(routing, bodies)
+        else:
+            self.publish_failed += len(bodies)
+
+    async def dispatch(self, routing: str, bodies: list):
+        """put serialized logs into queue of their shard, the task of shard sends them"""
+        await self.get_shard(routing).queue.put((routing, bodies))
+
+    async def send_ready(self, ready: list):
+        """dispatch list of (routing, bodies) returned by message batcher"""
+        for routing, bodies in ready:
+            await self.dispatch(routing, bodies)
 
     async def publish(self, record):
-        res = await self.base_publish(record)
-        if not res:  # unsuccessfully, maybe connection is closed, publish again
-            await self.base_publish(record)
+        try:
+            start = time.perf_counter()
+            routing, body = self.build_message(record)
+            self.metrics.serialize_seconds.observe(time.perf_counter() - start)
+        except Exception:
+            self.handleError(record)
+            return
+        if self.message_batcher is not None:
+            await self.send_ready(self.message_batcher.add(routing, body))
+        else:
+            await self.dispatch(routing, [body])
+
+    async def publish_priority(self, record):
+        """publish record of priority lane at once, without message batching"""
+        try:
+            start = time.perf_counter()
+            routing, body = self.build_message(record)
+            self.metrics.serialize_seconds.observe(time.perf_counter() - start)
+        except Exception:
+            self.handleError(record)
+            return
+        await self.send(routing, [body])
+
+    def emit_priority(self, record):
+        if len(self.priority_tasks) >= self.queue_size:
+            self.dropped_priority += 1
+            return
+        task = self.loop.create_task(self.publish_priority(record))
+        self.priority_tasks.add(task)
+        task.add_done_callback(self.priority_tasks.discard)
+
+    async def shard_send(self, shard: AioShard):
+        """task of shard, send a batch of messages of shard queue concurrently every time"""
+        while True:
+            items = [await shard.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(shard.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await asyncio.gather(*[self.send(routing, bodies) for routing, bodies in items])
+            finally:
+                for _ in items:
+                    shard.queue.task_done()
+
+    async def run_spool(self, func, *args):
+        """call method of spool in spool thread"""
+        return await asyncio.get_event_loop().run_in_executor(self.spool_executor, func, *args)
+
+    def append_spool(self, payloads: list):
+        """append payloads in spool thread, a payload can't be appended (eg: disk is full) is dropped"""
+        for payload in payloads:
+            try:
+                appended = self.spool.append(payload)
+            except Exception:
+                self.spool_failed += 1
+                sys.stdout.write("spool log error:\n")
+                traceback.print_exc()
+                continue
+            if appended:    # full spool counts dropped logs by itself
+                self.metrics.spooled += 1
+
+    async def spool_bodies(self, routing: str, bodies: list):
+        self.has_spooled = True
+        self.spool_appends += 1
+        await self.run_spool(self.append_spool, [pack_message(routing, body) for body in bodies])
+
+    async def replay_shard(self, shard: AioShard, messages: list):
+        """
+        publish logs of spool of one shard whose breaker allowed the request, return whether all logs are done.
+        Published logs are removed from messages, a log nacked max_replay_nacks times is dropped, so it doesn't
+        stop the spool forever.
+        :param messages: list of [routing, body, nacks]
+        """
+        try:
+            if shard.is_closed is True:
+                await self.rabbit_connect(shard)
+        except Exception as e:
+            shard.breaker.record_failure()
+            sys.stdout.write("replay {0} logs of shard {1} error: {2}\n".format(len(messages), shard.index, e))
+            await self.con_close(shard)
+            return False
+        results = await asyncio.gather(
+            *[self.publish_bodies(shard, routing, [body]) for routing, body, _ in messages], return_exceptions=True)
+        pending = []
+        error = None
+        for message, result in zip(messages, results):
+            if result is None:
+                continue
+            if isinstance(result, aiormq.exceptions.DeliveryError):
+                message[2] += 1
+                if message[2] >= self.max_replay_nacks:
+                    self.replay_nacked += 1
+                    continue
+            else:
+                error = result
+            pending.append(message)
+        messages[:] = pending
+        if error is not None:
+            shard.breaker.record_failure()
+            sys.stdout.write("replay {0} logs of shard {1} error: {2}\n".format(len(pending), shard.index, error))
+            await self.con_close(shard)
+            return False
+        # nack means connection is still fine
+        shard.breaker.record_success()
+        if pending:
+            sys.stdout.write("replay {0} logs of shard {1} error, messages are nacked\n".format(
+                len(pending), shard.index))
+            return False
+        return True
+
+    async def replay(self):
+        """publish logs of spool in order after connection recovers"""
+        interval = self.replay_interval
+        groups, position, published = None, None, set()
+        while True:
+            if groups is None:
+                appends = self.spool_appends
+                payloads, position = await self.run_spool(self.spool.read, self.batch_size)
+                if not payloads:
+                    if appends == self.spool_appends:
+                        self.has_spooled = False
+                    await asyncio.sleep(self.replay_interval)
+                    continue
+                groups = dict()     # shard index: (shard, [[routing, body, nacks]])
+                for routing, body in map(unpack_message, payloads):
+                    shard = self.get_shard(routing)
+                    groups.setdefault(shard.index, (shard, []))[1].append([routing, body, 0])
+            # batch is kept until all its logs are done, published logs aren't published again
+            # while the others are retried
+            pending = [(shard, messages) for index, (shard, messages) in groups.items() if index not in published]
+            # every breaker is asked, so each one allowing a probe gets success or failure
+            allowed = [(shard, messages) for shard, messages in pending if shard.breaker.allow_request()]
+            results = await asyncio.gather(*[self.replay_shard(shard, messages) for shard, messages in allowed])
+            published.update(shard.index for (shard, _), result in zip(allowed, results) if result)
+            if not all(results):
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, self.max_replay_interval)
+                continue
+            if len(published) < len(groups):
+                await asyncio.sleep(self.replay_interval)
+                continue
+            await self.run_spool(self.spool.ack, position)
+            groups = None
+            published.clear()
+            interval = self.replay_interval
+
+    def start(self):
+        """create queue and consumer task in current event loop"""
+        self.loop = asyncio.get_event_loop()
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            for shard in self.shards:
+                shard.connect_lock = asyncio.Lock()
+                shard.queue = asyncio.Queue(maxsize=self.queue_size)
+            self.confirm_semaphore = asyncio.Semaphore(self.confirm_window)
+        self.consumer = self.loop.create_task(self.consume())
+        for shard in self.shards:
+            if shard.sender is None or shard.sender.done():
+                shard.sender = self.loop.create_task(self.shard_send(shard))
+        if self.spool is not None and (self.replayer is None or self.replayer.done()):
+            self.replayer = self.loop.create_task(self.replay())
+
+    async def consume(self):
+        """the only task serializing log, take a batch of records from queue and dispatch them to shards"""
+        while True:
+            timeout = self.message_batcher.timeout() if self.message_batcher is not None else None
+            try:
+                batch = [await asyncio.wait_for(self.queue.get(), timeout)]
+            except asyncio.TimeoutError:
+                await self.send_ready(self.message_batcher.pop_expired())
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                for record in batch:
+                    await self.publish(record)
+                if self.message_batcher is not None:
+                    await self.send_ready(self.message_batcher.pop_expired())
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
 
     def emit(self, record):
+        self.metrics.emitted += 1
         self.acquire()
         try:
-            self.loop = asyncio.get_event_loop()
-            self.loop.create_task(self.publish(record))
+            if self.consumer is None or self.consumer.done():
+                self.start()
+            if self.priority_level is not None and record.levelno >= self.priority_level:
+                self.emit_priority(record)
+                return
+            if self.queue.full():
+                if self.overflow == OVERFLOW_DROP_OLDEST:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped_oldest += 1
+                else:
+                    self.dropped_newest += 1
+                    return
+            self.queue.put_nowait(record)
         except Exception:
             self.handleError(record)
             traceback.print_exc()
-        self.release()
+        finally:
+            self.release()
+
+    def stats(self):
+        """return counters, gauges and histograms of handler, see handler.metrics"""
+        dropped = {
+            "queue_full_oldest": self.dropped_oldest,
+            "queue_full_newest": self.dropped_newest,
+            "publish_failed": self.publish_failed,
+            "spool_failed": self.spool_failed,
+            "replay_nacked": self.replay_nacked,
+            "priority_lane_full": self.dropped_priority
+        }
+        gauges = {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "priority_publishing": len(self.priority_tasks),
+            "shard_queue_depth": sum(shard.queue.qsize() for shard in self.shards if shard.queue is not None),
+            "closed_connections": sum(1 for shard in self.shards if shard.is_closed)
+        }
+        if self.spool is not None:
+            with self.spool.lock:
+                dropped["spool_full"] = self.spool.dropped
+                gauges["spool_bytes"] = self.spool.size
+        return self.metrics.snapshot(self, dropped, gauges)
+
+    async def aflush(self):
+        """wait until all queued records are published"""
+        if self.priority_tasks:
+            await asyncio.gather(*list(self.priority_tasks))
+        if self.queue is not None:
+            await self.queue.join()
+        if self.message_batcher is not None:
+            await self.send_ready(self.message_batcher.pop_all())
+        for shard in self.shards:
+            if shard.queue is not None:
+                await shard.queue.join()
+
+    async def aclose(self):
+        """publish queued records, stop consumer task and close connection"""
+        await self.aflush()
+        for task in [self.consumer, self.replayer] + [shard.sender for shard in self.shards]:
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.consumer = None
+        self.replayer = None
+        for shard in self.shards:
+            shard.sender = None
+        if self.spool is not None:
+            await self.run_spool(self.spool.close)
+            self.spool_executor.shutdown()
+        for shard in self.shards:
+            await self.con_close(shard)
+        self.close()
@@ -0,0 +1,136 @@
+# -*- coding:utf-8 -*-
+
+"""
+Pack several logs sharing a routing key into one rabbitmq message.
+Body of message is NDJSON (serializer json/orjson) or a stream of msgpack objects (serializer msgpack),
+optionally compressed by gzip or zstd. Consumers can use decode_batch to get logs back.
+"""
+
+import gzip
+import json
+import time
+from .utils import CONTENT_TYPE_JSON, CONTENT_TYPE_MSGPACK
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CONTENT_TYPE_NDJSON = "application/x-ndjson"
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSIONS = (COMPRESSION_GZIP, COMPRESSION_ZSTD)
+
+HEADER_COUNT = "x-batch-count"      # number of logs in message
+HEADER_FORMAT = "x-batch-format"    # content type of one log
+
+
+def check_compression(compression: str = None):
+    if compression is None:
+        return
+    if compression not in COMPRESSIONS:
+        raise ValueError("compression should be one of {0}".format(COMPRESSIONS))
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        raise ImportError("compression zstd requires package zstandard")
+
+
+def compress(data: bytes, compression: str = None):
+    if compression == COMPRESSION_GZIP:
+        return gzip.compress(data, compresslevel=6)
+    elif compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(data: bytes, content_encoding: str = None):
+    if content_encoding == COMPRESSION_GZIP:
+        return gzip.decompress(data)
+    elif content_encoding == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ImportError("compression zstd requires package zstandard")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def encode_batch(bodies: list, content_type: str = CONTENT_TYPE_JSON, compression: str = None):
+    """
+    pack serialized logs into one message body
+    :param bodies: list of serialized logs
+    :param content_type: content type of one log, 'application/json' or 'application/msgpack'
+    :param compression: None, 'gzip' or 'zstd'
+    :return: (body, content_type, headers, content_encoding) of message
+    """
+    if content_type == CONTENT_TYPE_MSGPACK:
+        body, batch_content_type = b"".join(bodies), CONTENT_TYPE_MSGPACK
+    else:
+        body, batch_content_type = b"\n".join(bodies), CONTENT_TYPE_NDJSON
+    headers = {HEADER_COUNT: len(bodies), HEADER_FORMAT: content_type}
+    return compress(body, compression), batch_content_type, headers, compression
+
+
+def decode_batch(body: bytes, content_type: str = CONTENT_TYPE_NDJSON, content_encoding: str = None):
+    """
+    unpack message published with message batching, return list of logs.
+    eg: decode_batch(body, properties.content_type, properties.content_encoding)
+    """
+    body = decompress(body, content_encoding)
+    if content_type == CONTENT_TYPE_MSGPACK:
+        if msgpack is None:
+            raise ImportError("content type msgpack requires package msgpack")
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(body)
+        return list(unpacker)
+    elif content_type == CONTENT_TYPE_JSON:
+        return [json.loads(body)]
+    return [json.loads(line) for line in body.splitlines() if line]
+
+
+class MessageBatcher(object):
+    def __init__(self, batch_size: int = 100, batch_window: float = 1.0, max_bytes: int = 1024 * 1024):
+        """
+        Group serialized logs by routing key, a group is ready when it has batch_size logs, max_bytes bytes,
+        or its first log has waited batch_window seconds. It isn't thread-safe, only publisher uses it.
+        """
+        self.batch_size = max(int(batch_size), 1)
+        self.batch_window = batch_window
+        self.max_bytes = max_bytes
+        self.groups = dict()    # routing key: [created time, bytes, bodies]
+
+    def __len__(self):
+        return sum(len(group[2]) for group in self.groups.values())
+
+    def add(self, routing: str, body: bytes):
+        """add log, return list of ready (routing, bodies)"""
+        group = self.groups.get(routing)
+        if group is None:
+            group = self.groups[routing] = [time.monotonic(), 0, []]
+        group[1] += len(body)
+        group[2].append(body)
+        if len(group[2]) >= self.batch_size or group[1] >= self.max_bytes:
+            del self.groups[routing]
+            return [(routing, group[2])]
+        return []
+
+    def pop_expired(self):
+        """return list of (routing, bodies) waited batch_window seconds"""
+        deadline = time.monotonic() - self.batch_window
+        expired = [routing for routing, group in self.groups.items() if group[0] <= deadline]
+        return [(routing, self.groups.pop(routing)[2]) for routing in expired]
+
+    def pop_all(self):
+        ready = [(routing, group[2]) for routing, group in self.groups.items()]
+        self.groups = dict()
+        return ready
+
+    def timeout(self):
+        """seconds until the first group is expired, None if there is no log"""
+        if not self.groups:
+            return None
+        first = min(group[0] for group in self.groups.values())
+        return max(first + self.batch_window - time.monotonic(), 0)
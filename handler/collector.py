@@ -0,0 +1,361 @@
+# -*- coding:utf-8 -*-
+
+"""
+Process-wide log collector.
+Worker processes (eg: gunicorn workers) use CollectorHandler, which only serializes record and sends it
+as a length prefixed frame over a local unix stream socket. One collector process owns the real handlers
+(RabbitmqHandler, MySQLHandler...), so there is one broker connection or database pool per host, and records of
+all workers are batched together.
+
+run collector: python -m handler.collector --address /tmp/pylog.sock --config logging.json
+logging.json is a dictConfig of collector process, records are handled by the logger of their name.
+"""
+
+import os
+import sys
+import stat
+import json
+import time
+import struct
+import socket
+import signal
+import logging
+import logging.config
+import argparse
+import selectors
+import threading
+import traceback
+from datetime import datetime
+from .utils import EXCEPTION_FIELDS, FMT_EXC_FINGERPRINT, FMT_EXC_TRACEBACK, RecordProjector, get_serializer, \
+    format_exception
+from .metrics import HandlerMetrics
+
+# 转发给collector的日志记录属性
+RECORD_ATTRS = (
+    "name", "levelno", "levelname", "pathname", "filename", "module", "lineno", "funcName", "created", "msecs",
+    "relativeCreated", "thread", "threadName", "process", "processName", "repeat_count"
+)
+
+# 单条日志最大字节数，超过的日志被丢弃
+MAX_RECORD_SIZE = 1024 * 1024
+
+_FRAME_HEADER = struct.Struct(">I")     # length of serialized record
+
+# exc_info can't be sent, exception fields are computed in worker. Traceback is sent once as exc_text,
+# exc_traceback is computed from it in collector
+_exception_projector = RecordProjector(tuple(field for field in EXCEPTION_FIELDS if field != FMT_EXC_TRACEBACK))
+
+
+class CollectorHandler(logging.Handler):
+    def __init__(self, address: str, level=logging.NOTSET, buffer_size: int = 4 * 1024 * 1024, linger: float = 0.01,
+                 timeout: float = 1.0, retry_interval: float = 1.0):
+        """
+        Send log record to LogCollector by unix socket. emit only serializes record into a buffer, a sender thread
+        of the process writes buffered records to collector by one send.
+        Records are dropped when buffer is full, or collector isn't running. Connection and sender thread are created
+        in the process which emits, so handler created before fork is safe.
+        :param address: path of unix socket of collector
+        :param level: log level
+        :param buffer_size: max bytes of records waiting to be sent
+        :param linger: seconds sender thread waits for more records before sending
+        :param timeout: max seconds of one send, connection is closed after timeout
+        :param retry_interval: seconds to wait before connecting again
+        """
+        super(CollectorHandler, self).__init__(level)
+        self.metrics = HandlerMetrics(self)
+        self.address = address
+        self.buffer_size = buffer_size
+        self.linger = linger
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.dumps, _ = get_serializer()    # orjson or json, both are read by json.loads
+        self.dropped = 0
+        self.pid = None
+        self.after_fork()
+
+    def after_fork(self):
+        """socket, lock and thread of parent process aren't shared with forked child"""
+        self.socket = None
+        self.frames = []
+        self.buffered = 0
+        self.sending = 0
+        self.is_closing = False
+        self.cond = threading.Condition()
+        self.sender = None
+        self.pid = os.getpid()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        self.socket = sock
+
+    def serialize(self, record):
+        """serialize attributes of record needed by handlers of collector"""
+        attrs = record.__dict__
+        data = {attr: attrs.get(attr) for attr in RECORD_ATTRS}
+        data["msg"] = record.getMessage() if record.args else record.msg
+        if FMT_EXC_TRACEBACK in attrs:
+            # set by ExceptionDedupFilter, None for repeats of an exception
+            data["exc_text"] = attrs[FMT_EXC_TRACEBACK]
+        else:
+            if record.exc_info and not record.exc_text:
+                record.exc_text = format_exception(record.exc_info)
+            data["exc_text"] = record.exc_text
+        if record.exc_info or FMT_EXC_FINGERPRINT in attrs:
+            data.update(_exception_projector.project(record))
+        try:
+            return self.dumps(data)
+        except TypeError:
+            data["msg"] = str(data["msg"])
+            return self.dumps(data)
+
+    def handle(self, record):
+        """buffer has its own lock, emit without the handler lock"""
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        self.metrics.emitted += 1
+        try:
+            start = time.perf_counter()
+            data = self.serialize(record)
+            self.metrics.serialize_seconds.observe(time.perf_counter() - start)
+        except Exception:
+            self.handleError(record)
+            return
+        if self.pid != os.getpid():
+            self.after_fork()
+        frame = _FRAME_HEADER.pack(len(data)) + data
+        with self.cond:
+            if len(data) > MAX_RECORD_SIZE or self.buffered + len(frame) > self.buffer_size or self.is_closing:
+                self.dropped += 1
+                return
+            if self.sender is None:
+                self.sender = threading.Thread(target=self._send_loop, name="CollectorHandler-sender", daemon=True)
+                self.sender.start()
+            self.frames.append(frame)
+            self.buffered += len(frame)
+            if len(self.frames) == 1:
+                self.cond.notify_all()
+
+    def _send_loop(self):
+        next_connect = 0
+        has_connected = False
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.frames or self.is_closing)
+                if not self.frames:
+                    break
+                if not self.is_closing and self.linger > 0:
+                    # wait for more records, so records are sent by less send and thread switch
+                    self.cond.wait(self.linger)
+                frames, self.frames, self.buffered = self.frames, [], 0
+                self.sending = len(frames)
+            try:
+                if self.socket is None:
+                    if time.monotonic() < next_connect:
+                        raise OSError("wait to connect collector again")
+                    self.connect()
+                    if has_connected:
+                        self.metrics.reconnects += 1
+                    has_connected = True
+                start = time.perf_counter()
+                self.socket.sendall(b"".join(frames))
+                self.metrics.publish_seconds.observe(time.perf_counter() - start)
+                self.metrics.batch_size.observe(len(frames))
+            except OSError:  # collector isn't running or is too slow, frame may be broken so reconnect
+                if self.socket is None:
+                    next_connect = time.monotonic() + self.retry_interval
+                else:
+                    self.socket.close()
+                    self.socket = None
+                self.dropped += len(frames)
+            with self.cond:
+                self.sending = 0
+                self.cond.notify_all()
+
+    def stats(self):
+        """return counters, gauges and histograms of handler, see handler.metrics"""
+        gauges = {"queue_depth": len(self.frames), "buffer_bytes": self.buffered}
+        return self.metrics.snapshot(self, {"not_sent": self.dropped}, gauges)
+
+    def flush(self, timeout: float = None):
+        """wait until buffered records are sent"""
+        with self.cond:
+            if self.sender is not None and self.pid == os.getpid():
+                self.cond.wait_for(lambda: not self.frames and not self.sending, timeout=timeout)
+
+    def close(self):
+        if self.pid == os.getpid():
+            with self.cond:
+                self.is_closing = True
+                self.cond.notify_all()
+            if self.sender is not None:
+                self.sender.join()
+                self.sender = None
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+        super(CollectorHandler, self).close()
+
+
+class LogCollector(object):
+    def __init__(self, address: str, handlers: list = None, recv_size: int = 256 * 1024):
+        """
+        Receive records of CollectorHandler and hand them to the real handlers in one thread.
+        :param address: path of unix socket, an existing file is removed
+        :param handlers: handlers of records. If it is None, records are handled by logger of their name, which is
+        configured in collector process
+        :param recv_size: max bytes read from a worker connection at once
+        """
+        self.address = address
+        self.handlers = handlers
+        self.recv_size = recv_size
+        self.socket = None
+        self.selector = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.received = 0
+        self.decode_failed = 0
+
+    def bind(self):
+        try:
+            mode = os.lstat(self.address).st_mode
+        except FileNotFoundError:
+            mode = None
+        if mode is not None:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError("{0} exists and isn't a unix socket, refuse to remove it".format(self.address))
+            # socket left by the last collector
+            os.remove(self.address)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.address)
+        self.socket.listen(128)
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+
+    def close_connection(self, conn):
+        self.selector.unregister(conn)
+        conn.close()
+
+    def receive(self):
+        """return list of serialized records, wait at most 1 second"""
+        payloads = []
+        for key, _ in self.selector.select(timeout=1):
+            if key.data is None:
+                conn, _ = self.socket.accept()
+                conn.setblocking(False)
+                self.selector.register(conn, selectors.EVENT_READ, bytearray())
+                continue
+            try:
+                data = key.fileobj.recv(self.recv_size)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                data = b""
+            if not data:  # worker exits
+                self.close_connection(key.fileobj)
+                continue
+            buffer = key.data
+            buffer += data
+            offset = 0
+            while len(buffer) - offset >= _FRAME_HEADER.size:
+                size = _FRAME_HEADER.unpack_from(buffer, offset)[0]
+                if size > MAX_RECORD_SIZE:
+                    self.decode_failed += 1
+                    self.close_connection(key.fileobj)
+                    break
+                end = offset + _FRAME_HEADER.size + size
+                if len(buffer) < end:
+                    break
+                payloads.append(bytes(buffer[offset + _FRAME_HEADER.size:end]))
+                offset = end
+            del buffer[:offset]
+        return payloads
+
+    def dispatch(self, record):
+        if self.handlers is None:
+            logger = logging.getLogger(record.name)
+            if logger.isEnabledFor(record.levelno):
+                logger.handle(record)
+            return
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def serve_forever(self):
+        if self.socket is None:
+            self.bind()
+        while not self.stopped.is_set():
+            for payload in self.receive():
+                try:
+                    record = logging.makeLogRecord(json.loads(payload))
+                except ValueError:
+                    self.decode_failed += 1
+                    continue
+                self.received += 1
+                try:
+                    self.dispatch(record)
+                except Exception:
+                    msg = "{0} - [collector] Handle log failed.\n".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                    sys.stdout.write(msg)
+                    traceback.print_exc(file=sys.stdout)
+
+    def start(self):
+        """serve in a background thread"""
+        self.bind()
+        self.thread = threading.Thread(target=self.serve_forever, name="LogCollector", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.socket is not None:
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self.selector.close()
+            self.selector = None
+            self.socket = None
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+
+    def close(self):
+        """stop receiving, then flush and close handlers"""
+        self.stop()
+        for handler in self.handlers or []:
+            handler.flush()
+            handler.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m handler.collector", description="run process-wide log collector")
+    parser.add_argument("--address", required=True, help="path of unix socket")
+    parser.add_argument("--config", required=True, help="json file of logging dictConfig of collector")
+    args = parser.parse_args(argv)
+    with open(args.config) as f:
+        logging.config.dictConfig(json.load(f))
+    collector = LogCollector(args.address)
+    signal.signal(signal.SIGTERM, lambda signum, frame: collector.stopped.set())
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.stop()
+        logging.shutdown()
+
+
+if __name__ == "__main__":
+    main()
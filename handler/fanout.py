@@ -0,0 +1,233 @@
+# -*- coding:utf-8 -*-
+
+"""
+Fan-out handler, one record is handed to several sink handlers.
+The record is projected once into an immutable LogEvent, sinks handle the same event concurrently on a worker
+pool shared by all FanoutHandlers. Every sink has its own queue drained by one worker at a time, so records of
+a sink keep their order, and a slow sink doesn't delay the others.
+"""
+
+import sys
+import time
+import logging
+import importlib
+import threading
+import traceback
+from types import MappingProxyType
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from .utils import LOGGING_FORMAT_NAME, EXCEPTION_FIELDS, FMT_ASCTIME, FMT_MESSAGE, FMT_EXC_FINGERPRINT, \
+    FMT_EXC_TRACEBACK, RecordProjector, format_exception
+from .metrics import HandlerMetrics
+
+# 事件保存的日志记录属性, asctime和message由各sink生成
+EVENT_ATTRS = tuple(field for field in LOGGING_FORMAT_NAME if field not in (FMT_ASCTIME, FMT_MESSAGE)) + (
+    "msg", "args", "exc_info", "exc_text", "stack_info"
+)
+
+# 共享工作线程池的线程数
+DEFAULT_WORKERS = 4
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+# exception fields are computed once for all sinks
+_exception_projector = RecordProjector(EXCEPTION_FIELDS)
+
+
+def get_shared_pool():
+    """worker pool shared by FanoutHandlers, created when it is used first"""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = ThreadPoolExecutor(DEFAULT_WORKERS, thread_name_prefix="FanoutHandler-worker")
+        return _shared_pool
+
+
+class LogEvent(namedtuple("LogEventFields", EVENT_ATTRS + ("attrs",))):
+    __slots__ = ()
+
+    def __new__(cls, record):
+        """
+        Immutable snapshot of log record, it can be used as record by handlers and filters. It is a tuple,
+        so it is created without setting attributes one by one and it has no instance dict.
+        Traceback is formatted into exc_text once here, instead of once per sink. If ExceptionDedupFilter has
+        suppressed the traceback of a repeated exception, the event has no exc_info and exc_text, so sinks don't
+        print it either, while the record keeps them.
+        """
+        attrs = record.__dict__
+        is_suppressed = FMT_EXC_TRACEBACK in attrs and attrs[FMT_EXC_TRACEBACK] is None
+        if attrs.get("exc_info") and not attrs.get("exc_text") and not is_suppressed:
+            record.exc_text = format_exception(record.exc_info)
+        has_exception = attrs.get("exc_info") or FMT_EXC_FINGERPRINT in attrs
+        attrs = {attr: attrs.get(attr) for attr in EVENT_ATTRS}
+        if has_exception:
+            attrs.update(_exception_projector.project(record))
+        if is_suppressed:
+            attrs["exc_info"] = attrs["exc_text"] = None
+        return tuple.__new__(cls, (*attrs.values(), MappingProxyType(attrs)))
+
+    @property
+    def __dict__(self):
+        """read only attributes, so RecordProjector of handlers reads event like a record"""
+        return self.attrs
+
+    def getMessage(self):
+        msg = str(self.msg)
+        if self.args:
+            msg = msg % self.args
+        return msg
+
+
+def build_sink(sink):
+    """
+    return handler of sink
+    :param sink: a handler, or dict config of handler, eg: {"class": "handler.mysql.MySQLHandler", "level": "INFO",
+    "filters": [filter or {"()": "handler.filters.RateLimitFilter", "rate": 10}], **kwargs of handler class}
+    """
+    if isinstance(sink, logging.Handler):
+        return sink
+    config = dict(sink)
+    handler_class = resolve(config.pop("class"))
+    level = config.pop("level", None)
+    filters = config.pop("filters", [])
+    handler = handler_class(**config)
+    if level is not None:
+        handler.setLevel(level)
+    for item in filters:
+        if isinstance(item, dict):
+            item = dict(item)
+            item = resolve(item.pop("()"))(**item)
+        handler.addFilter(item)
+    return handler
+
+
+def reads_event(handler):
+    """
+    handlers of this package only read records, other handlers (eg: logging.StreamHandler) set attributes
+    of record when formatting, they get a LogRecord copy of event
+    """
+    return any(cls.__module__.split(".")[0] == __package__ for cls in type(handler).__mro__)
+
+
+def resolve(name):
+    """import object by dotted name, eg: handler.mysql.MySQLHandler"""
+    if not isinstance(name, str):
+        return name
+    module, _, attr = name.rpartition(".")
+    return getattr(importlib.import_module(module), attr)
+
+
+class SinkLane(object):
+    def __init__(self, handler, queue_size: int):
+        """
+        Queue of events of a sink, at most one worker drains it at a time.
+        :param handler: sink handler
+        :param queue_size: max events waiting, new events are dropped when queue is full
+        """
+        self.handler = handler
+        self.reads_event = reads_event(handler)
+        self.queue_size = queue_size
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.scheduled = False
+        self.dropped = 0
+
+    def put(self, event, pool):
+        with self.cond:
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                return
+            self.queue.append(event)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        try:
+            pool.submit(self.drain)
+        except RuntimeError:    # pool is shut down at interpreter exit
+            self.drain()
+
+    def drain(self):
+        while True:
+            with self.cond:
+                if not self.queue:
+                    self.scheduled = False
+                    self.cond.notify_all()
+                    return
+                events = list(self.queue)
+                self.queue.clear()
+            for event in events:
+                try:
+                    self.handler.handle(event if self.reads_event else logging.makeLogRecord(event.__dict__))
+                except Exception:
+                    msg = "{0} - [fanout] Sink {1} handle log failed.\n".format(
+                        datetime.now().strftime("%Y-%m-%d %H:%M:%S"), self.handler)
+                    sys.stdout.write(msg)
+                    traceback.print_exc(file=sys.stdout)
+
+    def wait(self, timeout: float = None):
+        """wait until queued events are handled"""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.scheduled, timeout=timeout)
+
+
+class FanoutHandler(logging.Handler):
+    def __init__(self, sinks: list, level=logging.NOTSET, pool=None, queue_size: int = 10000):
+        """
+        Hand every record to several sink handlers, eg: MySQLHandler and RabbitmqHandler.
+        Record is projected once into a LogEvent, level and filters of every sink still apply. Filters of sinks
+        can't modify the event, so DedupFilter should be added to logger or this handler. Sinks are flushed and
+        closed with this handler.
+        :param sinks: list of handlers, or dict configs of handlers, see build_sink
+        :param level: log level
+        :param pool: concurrent.futures.Executor running sinks, default is a pool shared by all FanoutHandlers
+        :param queue_size: max events waiting for one sink, new events of the sink are dropped when it is full
+        """
+        # sinks are created before this handler, so logging.shutdown closes this handler first
+        self.sinks = [build_sink(sink) for sink in sinks]
+        super(FanoutHandler, self).__init__(level)
+        self.metrics = HandlerMetrics(self)
+        self.pool = pool
+        self.lanes = [SinkLane(sink, max(int(queue_size), 1)) for sink in self.sinks]
+
+    def handle(self, record):
+        """lanes have their own locks, emit without the handler lock"""
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        self.metrics.emitted += 1
+        try:
+            start = time.perf_counter()
+            event = record if isinstance(record, LogEvent) else LogEvent(record)
+            self.metrics.serialize_seconds.observe(time.perf_counter() - start)
+        except Exception:
+            self.handleError(record)
+            return
+        pool = self.pool
+        if pool is None:
+            pool = self.pool = get_shared_pool()
+        for lane in self.lanes:
+            if event.levelno >= lane.handler.level:
+                lane.put(event, pool)
+
+    def stats(self):
+        """return counters, gauges and histograms of handler, see handler.metrics"""
+        dropped = {"queue_full_newest": sum(lane.dropped for lane in self.lanes)}
+        gauges = {"queue_depth": sum(len(lane.queue) for lane in self.lanes)}
+        return self.metrics.snapshot(self, dropped, gauges)
+
+    def flush(self, timeout: float = None):
+        """wait until queued events are handled by sinks, then flush sinks"""
+        for lane in self.lanes:
+            lane.wait(timeout)
+            lane.handler.flush()
+
+    def close(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+        super(FanoutHandler, self).close()
@@ -0,0 +1,167 @@
+# -*- coding:utf-8 -*-
+
+"""
+Filters against log storms, a broken loop may emit millions of identical logs.
+RateLimitFilter limits logs per routing key or per call site by token bucket,
+DedupFilter collapses identical logs in a time window into one record carrying 'repeat_count',
+ExceptionDedupFilter keeps the formatted traceback only for the first exception of a fingerprint in a time window.
+All of them keep a bounded number of keys, the least recently used key is evicted.
+Filters only set fields (repeat_count, exc_*) on the record, which is shared by all handlers of the logger,
+so add them to a logger, they work in front of all its handlers.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from .utils import FMT_REPEAT_COUNT, FMT_EXC_TYPE, FMT_EXC_MESSAGE, FMT_EXC_FINGERPRINT, FMT_EXC_TRACEBACK, \
+    FMT_EXC_COUNT, RoutingKeyPlanner, get_exc_info, exception_type, exception_message, exception_fingerprint, \
+    format_exception
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate: float, burst: int = None, routing_key: list = None, max_keys: int = 10000,
+                 name: str = ""):
+        """
+        Token bucket rate limiting, each key has its own bucket.
+        :param rate: logs per second allowed of one key
+        :param burst: max logs allowed at once of one key, default is rate
+        :param routing_key: fields list of key, same as routing_key of RabbitmqHandler, eg: ["name", "levelname"].
+        default is the call site (pathname, lineno)
+        :param max_keys: max keys kept, the least recently used key is evicted
+        :param name: same as logging.Filter
+        """
+        super(RateLimitFilter, self).__init__(name)
+        if rate <= 0:
+            raise ValueError("rate should be greater than 0")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.max_keys = max_keys
+        self.planner = RoutingKeyPlanner("", routing_key) if routing_key else None
+        self.buckets = OrderedDict()    # key: [tokens, last refill time]
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    def get_key(self, record):
+        if self.planner is not None:
+            return self.planner.get_record_routing_key(record)
+        return record.pathname, record.lineno
+
+    def filter(self, record):
+        if not super(RateLimitFilter, self).filter(record):
+            return False
+        key = self.get_key(record)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                self.suppressed += 1
+                return False
+            bucket[0] -= 1
+        return True
+
+
+class DedupFilter(logging.Filter):
+    def __init__(self, window: float = 60.0, max_keys: int = 10000, name: str = ""):
+        """
+        Suppress identical logs, which have the same call site, level and message, in a time window.
+        The first log passes with repeat_count 1. Repeats in the window are suppressed, the first log after the
+        window passes with repeat_count of itself and the suppressed repeats, and starts a new window.
+        :param window: seconds of a window
+        :param max_keys: max logs tracked, the least recently used one is evicted
+        :param name: same as logging.Filter
+        """
+        super(DedupFilter, self).__init__(name)
+        self.window = window
+        self.max_keys = max_keys
+        self.entries = OrderedDict()    # key: [window start time, suppressed repeats]
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    @staticmethod
+    def get_key(record):
+        msg = record.getMessage() if record.args else record.msg
+        try:
+            hash(msg)
+        except TypeError:   # eg: dict message
+            msg = str(msg)
+        return record.pathname, record.lineno, record.levelno, msg
+
+    def filter(self, record):
+        if not super(DedupFilter, self).filter(record):
+            return False
+        key = self.get_key(record)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.entries[key] = [now, 0]
+                if len(self.entries) > self.max_keys:
+                    self.entries.popitem(last=False)
+                repeat_count = 1
+            else:
+                self.entries.move_to_end(key)
+                if now - entry[0] < self.window:
+                    entry[1] += 1
+                    self.suppressed += 1
+                    return False
+                repeat_count = entry[1] + 1
+                entry[0], entry[1] = now, 0
+        setattr(record, FMT_REPEAT_COUNT, repeat_count)
+        return True
+
+
+class ExceptionDedupFilter(logging.Filter):
+    def __init__(self, window: float = 60.0, max_keys: int = 10000, name: str = ""):
+        """
+        Set exception fields (exc_type, exc_message, exc_fingerprint, exc_traceback, exc_count) on records with
+        exception, and format traceback only for the first exception of a fingerprint in a time window.
+        Later records of the fingerprint in the window pass with exc_count and exc_traceback None, handlers of this
+        package don't format or send their stack again. exc_info and exc_text of record are kept, so other handlers
+        (eg: logging.StreamHandler) still print the traceback.
+        :param window: seconds of a window
+        :param max_keys: max fingerprints tracked, the least recently used one is evicted
+        :param name: same as logging.Filter
+        """
+        super(ExceptionDedupFilter, self).__init__(name)
+        self.window = window
+        self.max_keys = max_keys
+        self.entries = OrderedDict()    # fingerprint: [window start time, exceptions in window]
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record):
+        if not super(ExceptionDedupFilter, self).filter(record):
+            return False
+        exc_info = get_exc_info(record)
+        if exc_info is None:
+            return True
+        fingerprint = exception_fingerprint(exc_info)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is None or now - entry[0] >= self.window:
+                entry = self.entries[fingerprint] = [now, 0]
+                if len(self.entries) > self.max_keys:
+                    self.entries.popitem(last=False)
+            self.entries.move_to_end(fingerprint)
+            entry[1] += 1
+            count = entry[1]
+        setattr(record, FMT_EXC_TYPE, exception_type(exc_info))
+        setattr(record, FMT_EXC_MESSAGE, exception_message(exc_info))
+        setattr(record, FMT_EXC_FINGERPRINT, fingerprint)
+        setattr(record, FMT_EXC_COUNT, count)
+        if count == 1:
+            setattr(record, FMT_EXC_TRACEBACK, record.exc_text or format_exception(exc_info))
+        else:
+            setattr(record, FMT_EXC_TRACEBACK, None)
+            self.suppressed += 1
+        return True
@@ -0,0 +1,194 @@
+# -*- coding:utf-8 -*-
+
+"""
+Runtime metrics of handlers.
+Every handler keeps a HandlerMetrics, handler.stats() returns its counters, gauges and histograms.
+prometheus_text() renders stats of all living handlers in prometheus text format, start_http_exporter serves it,
+and MetricsReporter passes stats to custom sinks periodically.
+Counters are plain attributes updated without lock, so the cost on emit is a few attribute operations.
+"""
+
+import sys
+import bisect
+import weakref
+import threading
+import traceback
+from datetime import datetime
+
+# 耗时分布桶(秒)
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+# 批大小分布桶
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+# 所有存活的handler
+_handlers = weakref.WeakSet()
+
+
+class Histogram(object):
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """return dict of cumulative bucket counts, sum and count"""
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class HandlerMetrics(object):
+    def __init__(self, handler):
+        """
+        Counters and histograms of a handler, handler is registered for prometheus_text and MetricsReporter.
+        emitted:    records passed to emit
+        retried:    publishes or inserts done again after failure, nack or timeout
+        reconnects: connections opened again to rabbitmq, database or collector, the first one isn't counted
+        spooled:    logs appended to disk spool
+        """
+        self.emitted = 0
+        self.retried = 0
+        self.reconnects = 0
+        self.spooled = 0
+        self.serialize_seconds = Histogram(LATENCY_BUCKETS)
+        self.publish_seconds = Histogram(LATENCY_BUCKETS)
+        self.batch_size = Histogram(SIZE_BUCKETS)
+        _handlers.add(handler)
+
+    def snapshot(self, handler, dropped: dict, gauges: dict):
+        """
+        return stats of handler
+        :param dropped: reason: number of dropped logs
+        :param gauges: name: current value, eg: queue depth
+        """
+        return {
+            "handler": type(handler).__name__,
+            "name": handler.get_name() or "{0}-{1:x}".format(type(handler).__name__, id(handler)),
+            "counters": {
+                "emitted": self.emitted,
+                "dropped": sum(dropped.values()),
+                "retried": self.retried,
+                "reconnects": self.reconnects,
+                "spooled": self.spooled,
+            },
+            "dropped": dropped,
+            "gauges": gauges,
+            "histograms": {
+                "serialize_seconds": self.serialize_seconds.snapshot(),
+                "publish_seconds": self.publish_seconds.snapshot(),
+                "batch_size": self.batch_size.snapshot(),
+            },
+        }
+
+
+def collect_stats():
+    """return list of stats of living handlers"""
+    return [handler.stats() for handler in list(_handlers)]
+
+
+def _labels(labels: dict):
+    return ",".join('{0}="{1}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                    for key, value in labels.items())
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def prometheus_text(stats: list = None, prefix: str = "pylog"):
+    """render stats in prometheus text exposition format, default is stats of all living handlers"""
+    stats = collect_stats() if stats is None else stats
+    samples = dict()    # metric name: (type, list of lines)
+
+    def add(name, metric_type, line):
+        samples.setdefault(name, (metric_type, []))[1].append(line)
+
+    for stat in stats:
+        labels = {"handler": stat["handler"], "name": stat["name"]}
+        for counter, value in stat["counters"].items():
+            name = "{0}_{1}_total".format(prefix, counter)
+            add(name, "counter", "{0}{{{1}}} {2}".format(name, _labels(labels), value))
+        for reason, value in stat["dropped"].items():
+            name = "{0}_dropped_by_reason_total".format(prefix)
+            add(name, "counter", "{0}{{{1}}} {2}".format(name, _labels(dict(labels, reason=reason)), value))
+        for gauge, value in stat["gauges"].items():
+            name = "{0}_{1}".format(prefix, gauge)
+            add(name, "gauge", "{0}{{{1}}} {2}".format(name, _labels(labels), value))
+        for histogram, value in stat["histograms"].items():
+            name = "{0}_{1}".format(prefix, histogram)
+            for bound, count in value["buckets"]:
+                bucket_labels = _labels(dict(labels, le=_format_bound(bound)))
+                add(name, "histogram", "{0}_bucket{{{1}}} {2}".format(name, bucket_labels, count))
+            add(name, "histogram", "{0}_sum{{{1}}} {2}".format(name, _labels(labels), value["sum"]))
+            add(name, "histogram", "{0}_count{{{1}}} {2}".format(name, _labels(labels), value["count"]))
+    lines = []
+    for name, (metric_type, metric_lines) in samples.items():
+        lines.append("# TYPE {0} {1}".format(name, metric_type))
+        lines.extend(metric_lines)
+    return "\n".join(lines) + "\n"
+
+
+def start_http_exporter(port: int, address: str = "", prefix: str = "pylog"):
+    """serve prometheus_text on http://address:port/metrics in a daemon thread, return the server"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = prometheus_text(prefix=prefix).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="MetricsExporter", daemon=True).start()
+    return server
+
+
+class MetricsReporter(threading.Thread):
+    def __init__(self, sinks: list, interval: float = 10.0):
+        """
+        Pass stats of all living handlers to sinks every interval seconds.
+        :param sinks: list of function(stats), stats is list of handler.stats()
+        :param interval: seconds between two reports
+        """
+        super(MetricsReporter, self).__init__(name="MetricsReporter", daemon=True)
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def report(self):
+        stats = collect_stats()
+        for sink in self.sinks:
+            try:
+                sink(stats)
+            except Exception:
+                msg = "{0} - [metrics] Sink {1} failed.\n".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), sink)
+                sys.stdout.write(msg)
+                traceback.print_exc(file=sys.stdout)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.report()
@@ -5,18 +5,20 @@ This is a logging handler of mysql.
 Currently, MySQL and SQLite databases are supported after testing
 """
 
-import os
+import re
 import sys
 import time
 import json
+import threading
 import traceback
 from logging import Handler, NOTSET
-from sqlalchemy.orm import sessionmaker, mapper
-from sqlalchemy import create_engine, Table, MetaData, Column, Integer, String, JSON, Boolean
-from sqlalchemy.ext.declarative import declarative_base
-from .utils import LOGGING_FORMAT_MAPPER, FMT_MESSAGE, FMT_ASCTIME, FMT_LEVELNAME, FMT_CREATED
-
-_mysql_fail_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "log/msqlhandler_error.log")
+from sqlalchemy import event, create_engine, inspect, Table, MetaData, Column, Index, Integer, String, Text, JSON, \
+    Boolean
+from sqlalchemy.engine.url import make_url
+from .utils import LOGGING_FORMAT_MAPPER, FMT_MESSAGE, FMT_LEVELNAME, RecordProjector, get_asctime_formatter, \
+    CircuitBreaker, CircuitOpenError
+from .spool import DiskSpool, SpoolReplayer, pack_row, unpack_row
+from .metrics import HandlerMetrics
 
 
 DEFAULT_ORIGIN_FIELDS = [FMT_LEVELNAME]
@@ -27,6 +29,29 @@ DEFAULT_MESSAGE_MAPPER = {
 }
 
 
+# column type name: (sqlalchemy type, python types of value)
+COLUMN_TYPES = {
+    "Integer": (Integer, (int, float)),
+    "String": (String, (str,)),
+    "Text": (Text, (str,)),
+    "JSON": (JSON, (dict,)),
+    "Boolean": (Boolean, (bool,)),
+}
+
+_COLUMN_TYPE_PATTERN = re.compile(r"^\s*(\w+)\s*(?:\(\s*(\d+)\s*\))?\s*$")
+
+PARTITION_DAY = "day"       # 按天分表, eg: log_20240131
+PARTITION_MONTH = "month"   # 按月分表, eg: log_202401
+
+# partition: strftime format of table name suffix
+PARTITION_FORMATS = {
+    PARTITION_DAY: "%Y%m%d",
+    PARTITION_MONTH: "%Y%m",
+}
+
+PARTITION_KEY = "_partition"    # key of table name suffix in row, it isn't a column
+
+
 class LogTableError(Exception):
     def __init__(self, msg=None):
         if msg is None:
@@ -43,45 +68,70 @@ class LogFieldNameConflictError(Exception):
 
 class LogOriginFieldError(Exception):
     def __init__(self, msg=None):
-        if msg in None:
+        if msg is None:
             msg = "logging original field error"
         super(LogOriginFieldError, self).__init__(msg)
 
 
-def check_type(field, value, field_mapper):
+def parse_column_type(type_name):
+    """
+    parse column type name, eg: 'String(50)', 'Integer'.
+    return (sqlalchemy type, python types of value)
+    """
+    match = _COLUMN_TYPE_PATTERN.match(type_name)
+    if match is None or match.group(1) not in COLUMN_TYPES:
+        raise LogTableError("column type {0} isn't supported, there are supported types: {1}".format(
+            type_name, list(COLUMN_TYPES)))
+    column_type, value_types = COLUMN_TYPES[match.group(1)]
+    if match.group(2) is not None:
+        if column_type is not String:
+            raise LogTableError("column type {0} doesn't have length".format(type_name))
+        return String(int(match.group(2))), value_types
+    return column_type, value_types
+
+
+def partition_period(partition, timestamp):
     """
-    Check whether the value type is correct
-    field: field name in log table
-    value: value of field
-    field_mapper: mapper between field name and value type in log tabel, you can reference DEFAULT_FIELDS.
+    return (start, end, table name suffix) of the partition containing timestamp, in local time
     """
-    if isinstance(value, (int, float)) and field_mapper.get(field, "").startswith("Integer"):
-        return True
-    elif isinstance(value, str) and field_mapper.get(field, "").startswith("String"):
-        return True
-    elif isinstance(value, dict) and field_mapper.get(field, "").startswith("JSON"):
-        return True
-    elif isinstance(value, bool) and field_mapper.get(field, "").startswith("Boolean"):
-        return True
+    t = time.localtime(timestamp)
+    if partition == PARTITION_DAY:
+        start, end = (t.tm_year, t.tm_mon, t.tm_mday), (t.tm_year, t.tm_mon, t.tm_mday + 1)
     else:
-        return False
+        start, end = (t.tm_year, t.tm_mon, 1), (t.tm_year, t.tm_mon + 1, 1)
+    # mktime normalizes day 32 or month 13
+    return (time.mktime(start + (0, 0, 0, 0, 0, -1)), time.mktime(end + (0, 0, 0, 0, 0, -1)),
+            time.strftime(PARTITION_FORMATS[partition], t))
 
 
-Base = declarative_base()
+def oldest_kept_suffix(partition, timestamp, retention):
+    """return table name suffix of the oldest partition kept, when retention partitions are kept at timestamp"""
+    t = time.localtime(timestamp)
+    if partition == PARTITION_DAY:
+        oldest = (t.tm_year, t.tm_mon, t.tm_mday - retention + 1)
+    else:
+        oldest = (t.tm_year, t.tm_mon - retention + 1, 1)
+    return time.strftime(PARTITION_FORMATS[partition], time.localtime(time.mktime(oldest + (0, 0, 0, 0, 0, -1))))
 
 
-def get_model(name, engine):
-    """get table model by tabel name"""
-    Base.metadata.reflect(engine)
-    table = Base.metadata.tables[name]
-    table_model = type(name, (object,), dict())
-    mapper(table_model, table)
-    Base.metadata.clear()
-    return table_model
+def list_partitions(engine, table_name, partition):
+    """return sorted table name suffixes of partition tables of table_name in database"""
+    pattern = re.compile(r"^{0}_(\d{{{1}}})$".format(
+        re.escape(table_name), len(time.strftime(PARTITION_FORMATS[partition], time.localtime(0)))))
+    suffixes = []
+    for name in inspect(engine).get_table_names():
+        match = pattern.match(name)
+        if match is not None:
+            suffixes.append(match.group(1))
+    return sorted(suffixes)
 
 
 class MySQLHandler(Handler):
-    def __init__(self, uri, table_name, level=NOTSET, origin_field=None, new_field=None):
+    def __init__(self, uri, table_name, level=NOTSET, origin_field=None, new_field=None, batch_size=1,
+                 flush_interval=None, datefmt=None, asctime_msecs=False, spool_path=None,
+                 spool_max_size=1024 * 1024 * 1024, circuit_breaker=None, reflect=False, pool_size=5,
+                 max_overflow=10, queue_size=100000, priority_level=None, partition=None, indexes=None,
+                 retention=None, purge_interval=3600):
         """
         myql log handler, send log to mysql database(or other sql database)
         :param uri:            str  mysql uri
@@ -89,27 +139,59 @@ class MySQLHandler(Handler):
         :param level:               log level
         :param origin_field:   list format string fields of defined by logging,
                                     for example 'asctime', 'levelname',...., but can't user 'message' field,
-                                    temporarily only support 'Integer', 'String', 'JSON' and 'Boolean' type.
+                                    temporarily only support 'Integer', 'String', 'Text', 'JSON' and 'Boolean' type.
         :param new_field:      dict Custom fields contained in the data table，eg: "user": "String(30)", these fields
                                     come from logging origin field message.If new_field only on field 'message'(eg:
                                     new_field={"message": "String(500)"}), will use log message as value as value,
                                     otherwise ignore 'message' field if this field in new_field.
-                                    Temporarily only support 'Integer', 'String', 'JSON' and 'Boolean' type.
+                                    Temporarily only support 'Integer', 'String', 'Text', 'JSON' and 'Boolean' type.
+        :param batch_size:     int  rows written by one multi-row INSERT. If batch_size > 1 or flush_interval is set,
+                                    emit only buffers the row and a background thread writes the buffer when it
+                                    reaches batch_size, every flush_interval seconds, on flush() and on close().
+        :param flush_interval: float max seconds a buffered row waits before being written, None means only flush
+                                    on size.
+        :param datefmt:        str  time.strftime format of 'asctime' field, or 'iso8601'. Default is
+                                    '%Y-%m-%d %H:%M:%S'.
+        :param asctime_msecs:  bool whether 'asctime' field contains milliseconds.
+        :param spool_path:     str  directory of disk spool. If it is set, rows that can't be inserted are appended
+                                    to spool, and a replayer thread inserts them in order after database recovers.
+        :param spool_max_size: int  max bytes of disk spool.
+        :param circuit_breaker: dict kwargs of CircuitBreaker, eg: {"failure_threshold": 3, "probe_interval": 1}.
+                                    While circuit is open, rows are appended to spool, or dropped if spool_path
+                                    isn't set.
+        :param reflect:        bool whether reflect log table from database. If False, the table defined by
+                                    origin_field and new_field is used, the table is created if it doesn't exist.
+        :param pool_size:      int  connections kept in pool, emit of different threads insert rows concurrently.
+                                    Ignored by SQLite.
+        :param max_overflow:   int  connections can be opened beyond pool_size. Ignored by SQLite.
+        :param queue_size:     int  max rows buffered in batch mode, new rows are dropped when buffer is full.
+        :param priority_level: int  in batch mode, rows of records with levelno >= priority_level (eg: logging.ERROR)
+                                    aren't buffered, they are inserted and committed in emit at once, so a full
+                                    buffer of lower rows never drops or delays them.
+        :param partition:      str  'day' or 'month'. Rows are inserted into one table per day or month named
+                                    table_name_20240131 or table_name_202401, by 'created' time of record. Tables are
+                                    created when the first row of the period is inserted.
+        :param indexes:        list fields with a secondary index, eg: ["created", "levelname", "name"]. Indexes
+                                    are created with the table, an existing table isn't altered.
+        :param retention:      int  partitions kept, including the current one. A purger thread drops tables of
+                                    expired partitions, whole tables are dropped instead of deleting rows.
+        :param purge_interval: float seconds between two purges of expired partitions.
         """
-        self.engine = create_engine(uri, pool_recycle=6 * 3600)  # pool will reconnect mysql database after 6 hour
-        self.Session = sessionmaker(bind=self.engine)
-        self.session = self.Session()
+        pool_kwargs = dict()
+        if make_url(uri).get_backend_name() != "sqlite":
+            pool_kwargs = dict(pool_size=pool_size, max_overflow=max_overflow)
+        # pool will reconnect mysql database after 6 hour, compiled INSERT statement is cached by engine
+        self.engine = create_engine(uri, pool_recycle=6 * 3600, **pool_kwargs).execution_options(compiled_cache={})
         metadata = MetaData()
         if origin_field is None:
-            self.origin_field = DEFAULT_ORIGIN_FIELDS
-        else:
-            self.origin_field = dict()
-            for field in origin_field:
-                if field not in LOGGING_FORMAT_MAPPER.keys():
-                    msg = "The element {0} in origin_field is not logging format field, \
-                    there are logging format fields: {0}".format(field, LOGGING_FORMAT_MAPPER)
-                    raise LogOriginFieldError(msg)
-                self.origin_field[field] = LOGGING_FORMAT_MAPPER.get(field)
+            origin_field = DEFAULT_ORIGIN_FIELDS
+        self.origin_field = dict()
+        for field in origin_field:
+            if field not in LOGGING_FORMAT_MAPPER.keys():
+                msg = "The element {0} in origin_field is not logging format field, \
+                there are logging format fields: {1}".format(field, list(LOGGING_FORMAT_MAPPER))
+                raise LogOriginFieldError(msg)
+            self.origin_field[field] = LOGGING_FORMAT_MAPPER.get(field)
         self.new_field = {}
         new_field = new_field if new_field else DEFAULT_MESSAGE_MAPPER
         for field, value in new_field.items():
@@ -117,51 +199,355 @@ class MySQLHandler(Handler):
                 raise LogFieldNameConflictError("new_field has same field with logging format field:{0}".format(field))
             elif field == FMT_MESSAGE:
                 if len(new_field) == 1:
-                    self.new_field = new_field
+                    self.new_field = dict(new_field)
             else:
                 self.new_field[field] = value
-        result = []
         self.fields = list(self.origin_field.items()) + list(self.new_field.items())
-        for name, type_name in self.fields:
-            result.append(Column(name, eval(type_name)))
-        result = tuple(result)
-        Table(table_name, metadata, Column('id', Integer, primary_key=True), *result)
-        metadata.create_all(self.engine)
-        self.LogModel = get_model(table_name, self.engine)
+        self.field_names = [name for name, _ in self.fields]
+        self.table_name = table_name
+        self.indexes = list(indexes or [])
+        for field in self.indexes:
+            if field not in self.field_names:
+                raise LogTableError("index field {0} isn't a field of log table: {1}".format(field, self.field_names))
+        if partition is not None and partition not in PARTITION_FORMATS:
+            raise LogTableError("partition should be one of {0}".format(list(PARTITION_FORMATS)))
+        if partition is not None and reflect:
+            raise LogTableError("partitioned log tables can't be reflected")
+        if retention is not None and (partition is None or retention < 1):
+            raise LogTableError("retention should be a positive number of partitions, and partition should be set")
+        self.partition = partition
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self._period = (0, 0, None)     # start, end and table name suffix of current partition
+        self._partition_tables = dict()  # table name suffix: insert statement of partition table
+        self._partition_lock = threading.Lock()
+        if partition is None:
+            self.table = self.define_table(table_name, metadata)
+            metadata.create_all(self.engine)
+            if reflect:
+                metadata = MetaData()
+                metadata.reflect(self.engine, only=[table_name])
+                self.table = metadata.tables[table_name]
+            self.insert_stmt = self.table.insert()
+        self.empty_row = dict.fromkeys(self.field_names)
+        # python types of value of new_field, message fields with other types are ignored
+        self.new_field_types = {field: parse_column_type(type_name)[1] for field, type_name in self.new_field.items()}
+        self.is_message_field = FMT_MESSAGE in self.new_field
+        self.asctime_formatter = get_asctime_formatter(datefmt, asctime_msecs)
+        self.projector = RecordProjector(self.origin_field, self.asctime_formatter)
         super(MySQLHandler, self).__init__(level)
+        self.metrics = HandlerMetrics(self)
+        event.listen(self.engine, "connect", self.on_connect)
+
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = flush_interval
+        self.is_batch = self.batch_size > 1 or flush_interval is not None
+        self._buffer = []
+        self.queue_size = max(int(queue_size), 1)
+        self.priority_level = priority_level
+        self.dropped_newest = 0
+        self._buffer_cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._is_closing = False
+        self._flusher = None
+        self.breaker = CircuitBreaker(**(circuit_breaker or {}))
+        self.insert_failed = 0
+        self.spool_failed = 0       # rows can't be packed or appended to spool (eg: disk is full)
+
+        self._purger = None
+        self._purger_stopped = threading.Event()
+        if retention is not None:
+            self._purger = threading.Thread(target=self._purge_loop, name="MySQLHandler-purger", daemon=True)
+            self._purger.start()
+
+        self.spool = None
+        self.replayer = None
+        if spool_path:
+            self.spool = DiskSpool(spool_path, max_size=spool_max_size)
+            self.replayer = SpoolReplayer(self.spool, self.replay, name="MySQLHandler-replayer")
+            self.replayer.start()
+        if self.is_batch:
+            self._flusher = threading.Thread(target=self._flush_loop, name="MySQLHandler-flusher", daemon=True)
+            self._flusher.start()
+
+    def define_table(self, name, metadata):
+        """define log table with columns of origin_field and new_field, and indexes"""
+        columns = [Column(field, parse_column_type(type_name)[0]) for field, type_name in self.fields]
+        table = Table(name, metadata, Column('id', Integer, primary_key=True), *columns)
+        for field in self.indexes:
+            # index name is unique in database for SQLite, so it contains table name
+            Index("ix_{0}_{1}".format(name, field), table.c[field])
+        return table
+
+    def get_partition_suffix(self, timestamp):
+        """table name suffix of partition of timestamp, period of the latest partition is cached"""
+        start, end, suffix = self._period
+        if not start <= timestamp < end:
+            start, end, suffix = self._period = partition_period(self.partition, timestamp)
+        return suffix
+
+    def get_partition_insert(self, suffix):
+        """return insert statement of partition table, the table is created if it doesn't exist"""
+        insert_stmt = self._partition_tables.get(suffix)
+        if insert_stmt is None:
+            with self._partition_lock:
+                insert_stmt = self._partition_tables.get(suffix)
+                if insert_stmt is None:
+                    metadata = MetaData()
+                    table = self.define_table("{0}_{1}".format(self.table_name, suffix), metadata)
+                    metadata.create_all(self.engine)
+                    insert_stmt = self._partition_tables[suffix] = table.insert()
+        return insert_stmt
+
+    def get_row(self, record):
+        """convert log record to a row dict of log table, every field of table is contained"""
+        row = self.empty_row.copy()
+        row.update(self.projector.project(record))
+        if self.partition is not None:
+            # not a column, sqlalchemy ignores it on insert, spooled rows keep their partition
+            row[PARTITION_KEY] = self.get_partition_suffix(record.created)
+        message = record.msg
+        if self.is_message_field:
+            if isinstance(message, dict):
+                message = json.dumps(message, ensure_ascii=True)
+            else:
+                message = "{0}".format(message)
+            message = {FMT_MESSAGE: message}
+        if isinstance(message, dict):
+            for field, value_types in self.new_field_types.items():
+                value = message.get(field)
+                if isinstance(value, value_types):
+                    row[field] = value
+        return row
+
+    def on_connect(self, dbapi_connection, connection_record):
+        """
+        count connections opened again by a pooled connection record (eg: after it is invalidated or recycled).
+        The first connection of a record isn't counted, so NullPool (eg: SQLite) opening one for every checkout
+        isn't seen as reconnects.
+        """
+        record_info = connection_record.record_info
+        if record_info.get("pylog_connected"):
+            self.metrics.reconnects += 1
+        record_info["pylog_connected"] = True
+
+    def serialize(self, record):
+        start = time.perf_counter()
+        row = self.get_row(record)
+        self.metrics.serialize_seconds.observe(time.perf_counter() - start)
+        return row
+
+    def handle(self, record):
+        """
+        emit without the handler lock, rows are inserted by connections of pool concurrently
+        """
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
 
     def emit(self, record):
-        self.acquire()
+        self.metrics.emitted += 1
+        if self.is_batch and (self.priority_level is None or record.levelno < self.priority_level):
+            self._emit_batch(record)
+            return
+        row = None
         try:
-            log_data = self.LogModel()
-            data = record.__dict__.copy()
-            data[FMT_ASCTIME] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(data.get(FMT_CREATED)))
-            data[FMT_MESSAGE] = data.get("msg")
-            for field in self.origin_field:
-                setattr(log_data, field, data.get(field))
-            message = data.get(FMT_MESSAGE)
-            if len(self.new_field) and FMT_MESSAGE in self.new_field:
-                if isinstance(message, dict):
-                    message = json.dumps(message, ensure_ascii=True)
-                else:
-                    message = "{0}".format(message)
-                message = {FMT_MESSAGE: message}
-            if isinstance(message, dict):
-                for field, value in message.items():
-                    if field not in self.new_field:
-                        continue
-                    if check_type(field, value, self.new_field):
-                        setattr(log_data, field, value)
-            self.session.add(log_data)
-            self.session.commit()
+            row = self.serialize(record)
+            if self.spool is not None and not self.spool.is_empty():
+                # rows in spool are inserted first, so keep order by spooling this one too
+                self.spool_rows([row])
+            elif not self.breaker.allow_request():  # fail fast while database is unavailable
+                self.spool_rows([row])
+            else:
+                self.insert_rows([row])
+                self.breaker.record_success()
+        except Exception:
+            if row is not None:
+                self.breaker.record_failure()
+            self.handleError(record)
+            traceback.print_exc(file=sys.stdout)
+            if row is not None:
+                self.spool_rows([row])
+
+    def _emit_batch(self, record):
+        try:
+            row = self.serialize(record)
         except Exception:
             self.handleError(record)
             traceback.print_exc(file=sys.stdout)
-        self.release()
+            return
+        with self._buffer_cond:
+            if len(self._buffer) >= self.queue_size:
+                self.dropped_newest += 1
+                return
+            self._buffer.append(row)
+            if len(self._buffer) >= self.batch_size:
+                self._buffer_cond.notify()
+
+    def _flush_loop(self):
+        """background thread, write buffer when it is full, flush_interval passed or handler closing"""
+        while True:
+            with self._buffer_cond:
+                if not self._is_closing and len(self._buffer) < self.batch_size:
+                    self._buffer_cond.wait(self.flush_interval)
+                is_closing = self._is_closing
+            try:
+                self._write_buffer()
+            except Exception:
+                msg = "{0} - [sql] Write buffered log rows failed.\n".format(time.strftime("%Y-%m-%d %H:%M:%S"))
+                sys.stdout.write(msg)
+                traceback.print_exc(file=sys.stdout)
+            if is_closing:
+                break
+
+    def _write_buffer(self):
+        """write all buffered rows by one multi-row INSERT, the lock keeps batches in order"""
+        with self._write_lock:
+            with self._buffer_cond:
+                rows, self._buffer = self._buffer, []
+            self.write_rows(rows)
+
+    def write_rows(self, rows):
+        """
+        insert rows by one multi-row INSERT, rows are appended to spool while spool isn't empty, circuit is open
+        or insert fails
+        """
+        if not rows:
+            return
+        if (self.spool is not None and not self.spool.is_empty()) or not self.breaker.allow_request():
+            self.spool_rows(rows)
+            return
+        try:
+            self.insert_rows(rows)
+            self.breaker.record_success()
+        except Exception:
+            self.breaker.record_failure()
+            msg = "{0} - [sql] Insert {1} log rows failed.\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), len(rows))
+            sys.stdout.write(msg)
+            traceback.print_exc(file=sys.stdout)
+            self.spool_rows(rows)
+
+    def insert_rows(self, rows):
+        start = time.perf_counter()
+        if self.partition is None:
+            with self.engine.begin() as conn:
+                conn.execute(self.insert_stmt, rows)
+        else:
+            partitions = dict()     # table name suffix: rows
+            for row in rows:
+                partitions.setdefault(row[PARTITION_KEY], []).append(row)
+            statements = [(self.get_partition_insert(suffix), partition_rows)
+                          for suffix, partition_rows in partitions.items()]
+            with self.engine.begin() as conn:
+                for insert_stmt, partition_rows in statements:
+                    conn.execute(insert_stmt, partition_rows)
+        self.metrics.publish_seconds.observe(time.perf_counter() - start)
+        self.metrics.batch_size.observe(len(rows))
+
+    def list_partitions(self):
+        """return sorted table name suffixes of partition tables in database"""
+        return list_partitions(self.engine, self.table_name, self.partition)
+
+    def purge_expired(self, now=None):
+        """drop tables of partitions older than retention, return dropped table names"""
+        oldest = oldest_kept_suffix(self.partition, time.time() if now is None else now, self.retention)
+        dropped = []
+        for suffix in self.list_partitions():
+            if suffix >= oldest:
+                break
+            with self._partition_lock:
+                self._partition_tables.pop(suffix, None)
+                table = Table("{0}_{1}".format(self.table_name, suffix), MetaData())
+                table.drop(self.engine, checkfirst=True)
+            dropped.append(table.name)
+        return dropped
+
+    def _purge_loop(self):
+        """background thread, drop expired partitions every purge_interval seconds"""
+        while True:
+            try:
+                self.purge_expired()
+            except Exception:
+                msg = "{0} - [sql] Purge expired partitions failed.\n".format(time.strftime("%Y-%m-%d %H:%M:%S"))
+                sys.stdout.write(msg)
+                traceback.print_exc(file=sys.stdout)
+            if self._purger_stopped.wait(self.purge_interval):
+                break
+
+    def spool_rows(self, rows):
+        """
+        append rows to spool one by one, rows are dropped if spool_path isn't set.
+        A row can't be packed (eg: value of JSON field isn't serializable) or appended (eg: disk is full) is dropped,
+        the others are still spooled.
+        """
+        if self.spool is None:
+            self.insert_failed += len(rows)
+            return
+        for row in rows:
+            try:
+                appended = self.spool.append(pack_row(row))
+            except Exception:
+                self.spool_failed += 1
+                msg = "{0} - [sql] Spool log row failed.\n".format(time.strftime("%Y-%m-%d %H:%M:%S"))
+                sys.stdout.write(msg)
+                traceback.print_exc(file=sys.stdout)
+                continue
+            if appended:    # full spool counts dropped rows by itself
+                self.metrics.spooled += 1
+
+    def replay(self, payloads):
+        """insert rows of spool, called by replayer thread"""
+        if not self.breaker.allow_request():
+            raise CircuitOpenError()
+        try:
+            self.insert_rows([unpack_row(payload) for payload in payloads])
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+
+    def stats(self):
+        """return counters, gauges and histograms of handler, see handler.metrics"""
+        return self.metrics.snapshot(self, *self._stats_items())
+
+    def _stats_items(self):
+        """return dict of dropped logs by reason and dict of gauges"""
+        dropped = {"insert_failed": self.insert_failed, "spool_failed": self.spool_failed,
+                   "queue_full_newest": self.dropped_newest}
+        gauges = {"queue_depth": len(self._buffer)}
+        if self.partition is not None:
+            gauges["partition_tables"] = len(self._partition_tables)
+        if hasattr(self.engine.pool, "checkedout"):    # NullPool of SQLite doesn't count connections
+            gauges["connections_in_use"] = self.engine.pool.checkedout()
+        if self.spool is not None:
+            with self.spool.lock:
+                dropped["spool_full"] = self.spool.dropped
+                gauges["spool_bytes"] = self.spool.size
+        return dropped, gauges
+
+    def flush(self):
+        if self.is_batch:
+            self._write_buffer()
 
     def close(self):
-        self.session.commit()
-        self.session.close()
+        if self._flusher is not None:
+            with self._buffer_cond:
+                self._is_closing = True
+                self._buffer_cond.notify()
+            self._flusher.join()
+            self._flusher = None
+            self._write_buffer()
+        if self.replayer is not None:
+            self.replayer.stop()
+            self.replayer = None
+            self.spool.close()
+        if self._purger is not None:
+            self._purger_stopped.set()
+            self._purger.join()
+            self._purger = None
+        self.engine.dispose()
+        super(MySQLHandler, self).close()
 
 
 if __name__ == "__main__":
@@ -5,21 +5,124 @@ This is a logging handler of rabbitmq.
 """
 
 import sys
-import json
 import time
 import pika
 import logging
+import itertools
+import threading
 import traceback
+from collections import deque, OrderedDict
 from datetime import datetime
 from .utils import (
     DEFAULT_EXCHANGE,
     DEFAULT_FORMAT,
     LOGGING_FORMAT_NAME,
     FMT_MESSAGE,
-    FMT_ASCTIME,
-    FMT_CREATED,
-    LogOriginFieldError
+    OVERFLOW_BLOCK,
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_POLICIES,
+    LogOriginFieldError,
+    RecordProjector,
+    RoutingKeyPlanner,
+    get_serializer,
+    get_asctime_formatter,
+    CircuitBreaker,
+    CircuitOpenError
 )
+from .spool import DiskSpool, SpoolReplayer, pack_message, unpack_message
+from .batch import MessageBatcher, check_compression, encode_batch
+from .metrics import HandlerMetrics
+
+PRIORITY_DRAIN_SIZE = 100  # max lower records published between two checks of priority lane
+
+
+class PooledChannel(object):
+    def __init__(self, handler, index: int, health_check_interval: float = 30.0):
+        """
+        One connection and channel of ChannelPool, it has its own lock and reconnects by itself.
+        :param handler: RabbitmqHandler owns the pool
+        :param index: index of channel in pool
+        :param health_check_interval: an idle connection processes heartbeats before publishing if it isn't used
+        for health_check_interval seconds, so a connection closed by broker is found and reconnected
+        """
+        self.handler = handler
+        self.index = index
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+        self.connection = None
+        self.channel = None
+        self.is_closed = True
+        self.has_connected = False
+        self.last_used = 0
+
+    def connect(self):
+        if self.has_connected:
+            self.handler.metrics.reconnects += 1
+        self.has_connected = True
+        param = pika.URLParameters(self.handler.uri)
+        self.connection = pika.BlockingConnection(param)
+        self.channel = self.connection.channel()
+        sys.stdout.write('%s - stdout - [rabbitmq] Connect success, pooled channel %d.\n' % (
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"), self.index))
+        if self.handler.is_exchange_declared is False:
+            self.handler.declare_exchange(self.channel)
+        self.is_closed = False
+
+    def check(self):
+        """reconnect if connection is closed, or is found closed by health check"""
+        if self.is_closed is False and time.monotonic() - self.last_used >= self.health_check_interval:
+            try:
+                self.connection.process_data_events(time_limit=0)
+            except Exception:
+                self.close()
+        if self.is_closed is False and (self.connection.is_closed or self.channel.is_closed):
+            self.close()
+        if self.is_closed is True:
+            self.connect()
+
+    def publish(self, routing: str, bodies: list):
+        """publish serialized logs, caller should hold lock"""
+        self.check()
+        for body in bodies:
+            self.handler.basic_publish(routing, body, channel=self.channel)
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            if self.channel and self.channel.is_closed is False:
+                self.channel.close()
+            if self.connection and self.connection.is_closed is False:
+                self.connection.close()
+        except Exception:
+            pass
+        finally:
+            self.channel = None
+            self.connection = None
+            self.is_closed = True
+
+
+class ChannelPool(object):
+    def __init__(self, handler, size: int):
+        """
+        Pool of connections and channels of RabbitmqHandler. Every thread is assigned a channel of the pool
+        round-robin and always publishes by it, so logs of one thread keep order and threads assigned to
+        different channels publish concurrently.
+        """
+        self.channels = [PooledChannel(handler, index) for index in range(max(int(size), 1))]
+        self._counter = itertools.count()
+        self._local = threading.local()
+
+    def get(self):
+        """return channel assigned to current thread"""
+        channel = getattr(self._local, "channel", None)
+        if channel is None:
+            channel = self._local.channel = self.channels[next(self._counter) % len(self.channels)]
+        return channel
+
+    def close(self):
+        for channel in self.channels:
+            with channel.lock:
+                channel.close()
 
 
 class RabbitmqHandler(logging.Handler):
@@ -30,7 +133,25 @@ class RabbitmqHandler(logging.Handler):
             exchange: str = DEFAULT_EXCHANGE,
             fields: list = None,
             level=logging.NOTSET,
-            routing_key: list = None
+            routing_key: list = None,
+            serializer: str = None,
+            datefmt: str = None,
+            asctime_msecs: bool = False,
+            async_mode: bool = False,
+            queue_size: int = 10000,
+            overflow: str = OVERFLOW_BLOCK,
+            spool_path: str = None,
+            spool_max_size: int = 1024 * 1024 * 1024,
+            circuit_breaker: dict = None,
+            message_batch_size: int = 1,
+            message_batch_window: float = 1.0,
+            compression: str = None,
+            publisher_confirms: bool = False,
+            confirm_window: int = 1000,
+            confirm_timeout: float = 30.0,
+            confirm_retries: int = 2,
+            pool_size: int = 0,
+            priority_level: int = None
     ):
         """
         Rabbitmq Handler emit log to rabbitmq
@@ -44,8 +165,39 @@ class RabbitmqHandler(logging.Handler):
         format string fields of defined by logging or fields of message where message is dict.
         If fields is not in log data, will use "*" replace. If element of routing_key is fields of message,
         should use dot separate, eg: 'message.field1.fields2', 'message.field1'.
+        :param serializer: 'json', 'orjson' or 'msgpack', content_type of message is set by serializer.
+        If param is None, use orjson when it is installed, otherwise json.
+        :param datefmt: time.strftime format of 'asctime' field, or 'iso8601'. Default is '%Y-%m-%d %H:%M:%S'.
+        :param asctime_msecs: whether 'asctime' field contains milliseconds.
+        :param async_mode: if True, emit only puts record into a bounded queue, a publisher thread owns the
+        connection and publishes records of queue.
+        :param queue_size: max size of queue in async mode.
+        :param overflow: what to do when queue is full in async mode, 'block' waits for free space,
+        'drop_oldest' drops the oldest record in queue, 'drop_newest' drops the record being emitted.
+        :param spool_path: directory of disk spool. If it is set, logs that can't be published are appended to
+        spool instead of retrying, and a replayer thread publishes them in order after connection recovers.
+        :param spool_max_size: max bytes of disk spool.
+        :param circuit_breaker: kwargs of CircuitBreaker, eg: {"failure_threshold": 3, "probe_interval": 1}.
+        While circuit is open, logs are appended to spool, or dropped if spool_path isn't set.
+        :param message_batch_size: if > 1, logs with same routing key are packed into one message (NDJSON, or
+        msgpack stream with serializer msgpack) of at most message_batch_size logs. Requires async_mode.
+        Consumers can unpack messages by handler.batch.decode_batch.
+        :param message_batch_window: max seconds a log waits for its message batch.
+        :param compression: compression of message batch, None, 'gzip' or 'zstd'.
+        :param publisher_confirms: enable publisher confirms, messages are published without waiting for ack,
+        at most confirm_window messages are unconfirmed. Requires async_mode.
+        :param confirm_window: max unconfirmed messages.
+        :param confirm_timeout: seconds to wait for ack, message is published again after timeout.
+        :param confirm_retries: times to publish again a nacked or timed out message, after that it is appended
+        to spool, or dropped if spool_path isn't set.
+        :param pool_size: if > 0, open pool_size connections, every thread publishes by the channel assigned to
+        it without the handler lock, so threads don't wait each other. Can't be used with async_mode.
+        :param priority_level: in async_mode, records with levelno >= priority_level (eg: logging.ERROR) are put
+        into a priority lane, publisher sends them before other records, without message batching, and waits
+        for their confirms. When queue is full, lower records are dropped to make room for them.
         """
         super(RabbitmqHandler, self).__init__(level)
+        self.metrics = HandlerMetrics(self)
         if len(appname) > 100:
             raise ValueError("application name is to long")
         self.appname = appname
@@ -67,101 +219,529 @@ class RabbitmqHandler(logging.Handler):
         if FMT_MESSAGE in routing_key:
             raise ValueError("message fild cat as routing key")
         self.routing_key = routing_key
+        self.asctime_formatter = get_asctime_formatter(datefmt, asctime_msecs)
+        self.projector = RecordProjector(self.origin_fields, self.asctime_formatter)
+        self.routing_planner = RoutingKeyPlanner(appname, routing_key, asctime_formatter=self.asctime_formatter)
+        self.dumps, self.content_type = get_serializer(serializer)
 
         self.connection = None
         self.channel = None
-        self.routing = None
 
         self.is_exchange_declared = False
+        self.has_connected = False      # the first connection isn't counted as reconnect
+        # publisher, replayer and emit of sync mode share the connection
+        self.connection_lock = threading.RLock()
+        self.breaker = CircuitBreaker(**(circuit_breaker or {}))
+        self.publish_failed = 0
+        self.spool_failed = 0       # logs can't be appended to spool (eg: disk is full)
 
-        self.connect()
-        self.is_closed = False
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow should be one of {0}".format(OVERFLOW_POLICIES))
+        self.async_mode = async_mode
+        self.queue_size = max(int(queue_size), 1)
+        self.overflow = overflow
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.priority_level = priority_level
+        self.dropped_for_priority = 0   # lower records dropped to make room for priority records
+        self.dropped_reentrant = 0      # records logged (eg: by pika) by the thread publishing
+        # publishing is True for the thread using connection (publisher, replayer, or emit of sync mode),
+        # records it logs come back into handle
+        self._local = threading.local()
+        self._queue = deque()
+        self._priority_queue = deque()
+        self._queue_cond = threading.Condition()
+        self._is_stopping = False
+        self._flush_requests = 0
+        self._flush_done = 0
+        self._publisher = None
+
+        self.message_batcher = None
+        self.compression = compression
+        if message_batch_size > 1:
+            if not async_mode:
+                raise ValueError("message batching requires async_mode")
+            check_compression(compression)
+            self.message_batcher = MessageBatcher(message_batch_size, message_batch_window)
+
+        if publisher_confirms and not async_mode:
+            raise ValueError("publisher confirms requires async_mode")
+        self.publisher_confirms = publisher_confirms
+        self.confirm_window = max(int(confirm_window), 1)
+        self.confirm_timeout = confirm_timeout
+        self.confirm_retries = confirm_retries
+        self.delivery_tag = 0
+        self.unconfirmed = OrderedDict()    # delivery tag: [routing, bodies, publish time, attempts]
+        self.nacked = []                    # [routing, bodies, publish time, attempts] to publish again
+
+        self.channel_pool = None
+        if pool_size > 0:
+            if async_mode:
+                raise ValueError("channel pool can't be used with async_mode")
+            self.channel_pool = ChannelPool(self, pool_size)
+
+        self.spool = None
+        self.replayer = None
+        if spool_path:
+            self.spool = DiskSpool(spool_path, max_size=spool_max_size)
+
+        # connect to rabbitmq when the first log is published
+        self.is_closed = True
+        if self.async_mode:
+            self._publisher = threading.Thread(target=self._publish_loop, name="RabbitmqHandler-publisher", daemon=True)
+            self._publisher.start()
+
+        if self.spool is not None:
+            self.replayer = SpoolReplayer(self.spool, self.replay, name="RabbitmqHandler-replayer")
+            self.replayer.start()
 
     def connect(self):
         """
         connent rabbitmq server
         """
+        if self.has_connected:
+            self.metrics.reconnects += 1
+        self.has_connected = True
         param = pika.URLParameters(self.uri)
         self.connection = pika.BlockingConnection(param)
         self.channel = self.connection.channel()
+        if self.publisher_confirms:
+            # confirm mode of BlockingChannel waits for every ack, so enable it on the underlying channel
+            # and receive acks by callback
+            self.delivery_tag = 0
+            self.channel._impl.confirm_delivery(ack_nack_callback=self.on_delivery_confirmation)
         sys.stdout.write('%s - stdout - [rabbitmq] Connect success.\n' % datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
         if self.is_exchange_declared is False:
-            self.channel.exchange_declare(
-                exchange=self.exchange,
-                exchange_type="topic",
-                passive=False,
-                durable=True,
-                auto_delete=False
-            )
-            self.is_exchange_declared = True
+            self.declare_exchange(self.channel)
+
+    def declare_exchange(self, channel):
+        channel.exchange_declare(
+            exchange=self.exchange,
+            exchange_type="topic",
+            passive=False,
+            durable=True,
+            auto_delete=False
+        )
+        self.is_exchange_declared = True
 
     def get_routing_key(self, data: dict):
-        origin_data = data
-        routing = self.appname + "."
-        for field in self.routing_key:
-            value = None
-            keys = field.split(".")
-            data = origin_data
-            for index, key in enumerate(keys):
-                value = data.get(key)
-                data = value
-                if not isinstance(data, dict):
-                    if index == len(keys) - 1 and value is not None:
-                        value = str(value)
-                    break
-            if not isinstance(value, str):
-                value = "*"
-            routing += str(value) + "."
-        routing = routing[:-1]
-        if len(self.appname) < 255 < len(routing):
-            routing = self.appname + ".*" * len(self.routing_key)
-        if len(routing) > 255:
-            routing = routing[:255]
-        return routing
-
-    def _emit(self, record):
-        log_data = dict()
-        origin_data = record.__dict__.copy()
-        origin_data[FMT_ASCTIME] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(origin_data.get(FMT_CREATED)))
-        origin_data[FMT_MESSAGE] = origin_data.get("msg")
-        for field in self.origin_fields:
-            log_data[field] = origin_data.get(field)
-        routing = self.get_routing_key(origin_data)
-        self.channel.basic_publish(
+        return self.routing_planner.get_routing_key(data)
+
+    def basic_publish(self, routing: str, body: bytes, content_type: str = None, headers: dict = None,
+                      content_encoding: str = None, channel=None):
+        (channel or self.channel).basic_publish(
             exchange=self.exchange,
             routing_key=routing,
-            body=json.dumps(log_data, ensure_ascii=False),
-            properties=pika.BasicProperties(delivery_mode=2)
+            body=body,
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+                content_type=content_type or self.content_type,
+                headers=headers,
+                content_encoding=content_encoding
+            )
         )
 
-    def emit(self, record):
-        self.acquire()
-        count = 2
-        while count > 0:
+    def build_message(self, record):
+        """return (routing key, serialized log)"""
+        return self.routing_planner.get_record_routing_key(record), self.dumps(self.projector.project(record))
+
+    def publish(self, record, is_priority: bool = False):
+        """
+        publish record
+        :param is_priority: record of priority lane isn't batched
+        """
+        try:
+            start = time.perf_counter()
+            routing, body = self.build_message(record)
+            self.metrics.serialize_seconds.observe(time.perf_counter() - start)
+        except Exception:
+            self.handleError(record)
+            traceback.print_exc(file=sys.stdout)
+            return
+        if self.message_batcher is not None and not is_priority:
+            for routing, bodies in self.message_batcher.add(routing, body):
+                self.send(routing, bodies)
+            return
+        self.send(routing, [body], record)
+
+    def publish_bodies(self, routing: str, bodies: list, attempts: int = 0):
+        """publish serialized logs, track delivery tags of them if publisher confirms is enabled"""
+        start = time.perf_counter()
+        if self.message_batcher is not None:
+            messages = [(bodies, encode_batch(bodies, self.content_type, self.compression))]
+        else:
+            messages = [([body], (body,)) for body in bodies]
+        for message_bodies, message in messages:
+            if self.publisher_confirms:
+                self.wait_confirm_window()
+            self.basic_publish(routing, *message)
+            if self.publisher_confirms:
+                self.delivery_tag += 1
+                self.unconfirmed[self.delivery_tag] = [routing, message_bodies, time.monotonic(), attempts]
+        self.metrics.publish_seconds.observe(time.perf_counter() - start)
+        self.metrics.batch_size.observe(len(bodies))
+
+    def send(self, routing: str, bodies: list, record=None, attempts: int = 0):
+        """publish serialized logs, they are packed into one message in message batching mode"""
+        if self.spool is not None and not self.spool.is_empty():
+            # logs in spool are sent first, so keep order by spooling these too
+            self.spool_bodies(routing, bodies)
+            return
+        if self.channel_pool is not None:
+            self.send_pooled(routing, bodies, record)
+            return
+        count = 1 if self.spool is not None else 2
+        with self.connection_lock:
+            while count > 0 and self.breaker.allow_request():
+                try:
+                    if self.is_closed is True:
+                        self.connect()
+                        self.is_closed = False
+                    self.publish_bodies(routing, bodies, attempts)
+                    self.breaker.record_success()
+                    return
+                except Exception:
+                    self.breaker.record_failure()
+                    if record is not None:
+                        self.handleError(record)
+                    traceback.print_exc(file=sys.stdout)
+                    self.close_connection()
+                    self.is_closed = True
+                    count -= 1
+                    if count > 0:
+                        self.metrics.retried += 1
+        self.fallback(routing, bodies)
+
+    def send_pooled(self, routing: str, bodies: list, record=None):
+        """publish serialized logs by the pooled channel of current thread"""
+        pooled = self.channel_pool.get()
+        count = 1 if self.spool is not None else 2
+        with pooled.lock:
+            while count > 0 and self.breaker.allow_request():
+                try:
+                    start = time.perf_counter()
+                    pooled.publish(routing, bodies)
+                    self.metrics.publish_seconds.observe(time.perf_counter() - start)
+                    self.metrics.batch_size.observe(len(bodies))
+                    self.breaker.record_success()
+                    return
+                except Exception:
+                    self.breaker.record_failure()
+                    if record is not None:
+                        self.handleError(record)
+                    traceback.print_exc(file=sys.stdout)
+                    pooled.close()
+                    count -= 1
+                    if count > 0:
+                        self.metrics.retried += 1
+        self.fallback(routing, bodies)
+
+    def fallback(self, routing: str, bodies: list):
+        """logs can't be published are appended to spool, or dropped if spool_path isn't set"""
+        if self.spool is not None:
+            self.spool_bodies(routing, bodies)
+        else:
+            self.publish_failed += len(bodies)
+
+    def on_delivery_confirmation(self, frame):
+        """ack or nack of broker, one frame may confirm all messages up to its delivery tag"""
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self.unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        is_ack = isinstance(method, pika.spec.Basic.Ack)
+        for tag in tags:
+            message = self.unconfirmed.pop(tag, None)
+            if message is not None and not is_ack:
+                self.nacked.append(message)
+
+    def expire_unconfirmed(self):
+        """messages waited confirm_timeout seconds are treated as nacked"""
+        deadline = time.monotonic() - self.confirm_timeout
+        while self.unconfirmed:
+            tag, message = next(iter(self.unconfirmed.items()))
+            if message[2] > deadline:
+                break
+            del self.unconfirmed[tag]
+            self.nacked.append(message)
+
+    def wait_confirm_window(self):
+        """wait until unconfirmed messages are less than confirm_window"""
+        while len(self.unconfirmed) >= self.confirm_window:
+            self.connection.process_data_events(time_limit=0.01)
+            self.expire_unconfirmed()
+
+    def republish_nacked(self):
+        """publish nacked or timed out messages again, or fallback after confirm_retries times"""
+        with self.connection_lock:
+            self.expire_unconfirmed()
+            nacked, self.nacked = self.nacked, []
+        for routing, bodies, _, attempts in nacked:
+            if attempts >= self.confirm_retries:
+                self.fallback(routing, bodies)
+            else:
+                self.metrics.retried += 1
+                self.send(routing, bodies, attempts=attempts + 1)
+
+    def wait_confirms(self, timeout: float = None):
+        """wait until all published messages are confirmed"""
+        timeout = self.confirm_timeout * (self.confirm_retries + 1) if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while (self.unconfirmed or self.nacked) and time.monotonic() < deadline:
+            self.process_data_events(time_limit=0.01)
+            self.republish_nacked()
+
+    def spool_bodies(self, routing: str, bodies: list):
+        """append logs to spool, a log can't be appended (eg: disk is full) is dropped"""
+        for body in bodies:
+            try:
+                appended = self.spool.append(pack_message(routing, body))
+            except Exception:
+                self.spool_failed += 1
+                sys.stdout.write('%s - stdout - [rabbitmq] Spool log failed.\n' % (
+                    datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                traceback.print_exc(file=sys.stdout)
+                continue
+            if appended:    # full spool counts dropped logs by itself
+                self.metrics.spooled += 1
+
+    def replay(self, payloads: list):
+        """publish logs of spool, called by replayer thread"""
+        self._local.publishing = True
+        if not self.breaker.allow_request():
+            raise CircuitOpenError()
+        if self.channel_pool is not None:
+            pooled = self.channel_pool.get()
+            with pooled.lock:
+                try:
+                    for payload in payloads:
+                        routing, body = unpack_message(payload)
+                        pooled.publish(routing, [body])
+                except Exception:
+                    self.breaker.record_failure()
+                    pooled.close()
+                    raise
+            self.breaker.record_success()
+            return
+        with self.connection_lock:
             try:
                 if self.is_closed is True:
                     self.connect()
                     self.is_closed = False
-                self._emit(record)
-                break
+                for payload in payloads:
+                    routing, body = unpack_message(payload)
+                    self.publish_bodies(routing, [body])
+            except Exception:
+                self.breaker.record_failure()
+                self.close_connection()
+                self.is_closed = True
+                raise
+        self.breaker.record_success()
+
+    def handle(self, record):
+        if getattr(self._local, "publishing", False):
+            # eg: pika logs while publisher thread connects, it can't wait for queue space it frees itself
+            self.dropped_reentrant += 1
+            return False
+        if self.channel_pool is None and not self.async_mode:
+            return super(RabbitmqHandler, self).handle(record)
+        # queue and channels of pool have their own locks, emit without the handler lock,
+        # so a thread waiting for queue space doesn't block other threads holding the handler lock
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        self.metrics.emitted += 1
+        if self.async_mode:
+            self.enqueue(record)
+            return
+        # pika logs while connecting come back into handle of this thread, they are dropped instead of
+        # connecting again, or waiting for the lock of pooled channel held by this thread
+        is_pooled = self.channel_pool is not None
+        if not is_pooled:
+            self.acquire()
+        self._local.publishing = True
+        try:
+            self.publish(record)
+        finally:
+            self._local.publishing = False
+            if not is_pooled:
+                self.release()
+
+    def queued(self):
+        return len(self._queue) + len(self._priority_queue)
+
+    def enqueue(self, record):
+        """put record into bounded queue, handle full queue by overflow policy"""
+        is_priority = self.priority_level is not None and record.levelno >= self.priority_level
+        with self._queue_cond:
+            if self._is_stopping:
+                self.dropped_newest += 1
+                return
+            if self.queued() >= self.queue_size:
+                if is_priority and self._queue:
+                    # lower records are dropped first
+                    self._queue.popleft()
+                    self.dropped_for_priority += 1
+                elif self.overflow == OVERFLOW_BLOCK:
+                    while self.queued() >= self.queue_size and not self._is_stopping:
+                        self._queue_cond.wait()
+                elif self.overflow == OVERFLOW_DROP_OLDEST and (self._queue or is_priority):
+                    (self._queue or self._priority_queue).popleft()
+                    self.dropped_oldest += 1
+                else:
+                    self.dropped_newest += 1
+                    return
+            if is_priority:
+                self._priority_queue.append(record)
+            else:
+                self._queue.append(record)
+            self._queue_cond.notify_all()
+
+    def _wait_timeout(self):
+        """seconds publisher waits for new records"""
+        if self.unconfirmed or self.nacked:
+            return 0.05
+        timeout = self.message_batcher.timeout() if self.message_batcher is not None else None
+        return 1 if timeout is None else min(timeout, 1)
+
+    def _publish_loop(self):
+        """publisher thread, the only user of connection in async mode"""
+        self._local.publishing = True
+        while True:
+            with self._queue_cond:
+                while not self.queued() and not self._is_stopping and self._flush_done >= self._flush_requests:
+                    timeout = self._wait_timeout()
+                    if not self._queue_cond.wait(timeout=timeout) and (timeout < 1 or self.is_closed is False):
+                        break
+                priority_records = list(self._priority_queue)
+                self._priority_queue.clear()
+                if self.priority_level is None:
+                    records = list(self._queue)
+                    self._queue.clear()
+                else:
+                    # take part of lower records, so new priority records don't wait for a long queue
+                    records = [self._queue.popleft() for _ in range(min(len(self._queue), PRIORITY_DRAIN_SIZE))]
+                if records or priority_records:
+                    self._queue_cond.notify_all()
+                is_stopping, flush_requests = self._is_stopping, self._flush_requests
+                # flush is done after all records in queue are taken
+                is_flushing = (is_stopping or flush_requests > self._flush_done) and not self._queue
+            try:
+                self._publish_records(priority_records, records, is_flushing, is_stopping)
             except Exception:
-                self.handleError(record)
+                # publisher must keep running, or emit of overflow block and flush wait for it forever
+                sys.stdout.write('%s - stdout - [rabbitmq] Publisher publish logs failed.\n' % (
+                    datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
                 traceback.print_exc(file=sys.stdout)
-                self.close()
+            with self._queue_cond:
+                if is_flushing:
+                    self._flush_done = flush_requests
+                self._queue_cond.notify_all()
+            if is_stopping and not records and not priority_records:
+                break
+
+    def _publish_records(self, priority_records: list, records: list, is_flushing: bool, is_stopping: bool):
+        """publish records taken from queue by publisher thread"""
+        for record in priority_records:
+            self.publish(record, is_priority=True)
+        if priority_records and self.publisher_confirms:
+            self.wait_confirms()
+        for record in records:
+            self.publish(record)
+        if self.message_batcher is not None:
+            ready = self.message_batcher.pop_all() if is_flushing else self.message_batcher.pop_expired()
+            for routing, bodies in ready:
+                self.send(routing, bodies)
+        if self.publisher_confirms:
+            if is_flushing:
+                self.wait_confirms()
+            else:
+                self.process_data_events()
+                self.republish_nacked()
+        elif not records and not is_stopping:
+            self.process_data_events()
+
+    def process_data_events(self, time_limit: float = 0):
+        """keep heartbeat of idle connection and receive acks"""
+        with self.connection_lock:
+            if self.is_closed is True:
+                return
+            try:
+                self.connection.process_data_events(time_limit=time_limit)
+            except Exception:
+                self.close_connection()
                 self.is_closed = True
-                count -= 1
-        self.release()
 
-    def close(self):
-        """
-        clear when closing
-        """
+    def flush(self, timeout: float = None):
+        """wait until all queued records are published (and confirmed) in async mode"""
+        if self._publisher is None:
+            return
+        with self._queue_cond:
+            self._flush_requests += 1
+            request = self._flush_requests
+            self._queue_cond.notify_all()
+            self._queue_cond.wait_for(lambda: self._flush_done >= request, timeout=timeout)
+
+    def stats(self):
+        """return counters, gauges and histograms of handler, see handler.metrics"""
+        dropped = {
+            "queue_full_oldest": self.dropped_oldest,
+            "queue_full_newest": self.dropped_newest,
+            "publish_failed": self.publish_failed,
+            "spool_failed": self.spool_failed,
+            "dropped_for_priority": self.dropped_for_priority,
+            "reentrant": self.dropped_reentrant
+        }
+        gauges = {
+            "queue_depth": len(self._queue),
+            "priority_queue_depth": len(self._priority_queue),
+            "unconfirmed": len(self.unconfirmed) + len(self.nacked)
+        }
+        if self.spool is not None:
+            with self.spool.lock:
+                dropped["spool_full"] = self.spool.dropped
+                gauges["spool_bytes"] = self.spool.size
+        return self.metrics.snapshot(self, dropped, gauges)
+
+    def close_connection(self):
         try:
             if self.channel and self.channel.is_closed is False:
                 self.channel.close()
-                self.channel = None
             if self.connection and self.connection.is_closed is False:
                 self.connection.close()
-                self.connection = None
-        finally:
+        except Exception:
             pass
+        finally:
+            self.channel = None
+            self.connection = None
+            # ack of unconfirmed messages is lost with the channel, publish them again
+            self.nacked.extend(self.unconfirmed.values())
+            self.unconfirmed.clear()
+
+    def close(self):
+        """
+        clear when closing
+        """
+        if self._publisher is not None:
+            self.flush()
+            with self._queue_cond:
+                self._is_stopping = True
+                self._queue_cond.notify_all()
+            self._publisher.join()
+            self._publisher = None
+        if self.replayer is not None:
+            self.replayer.stop()
+            self.replayer = None
+        self.close_connection()
+        if self.channel_pool is not None:
+            self.channel_pool.close()
+        for routing, bodies, _, _ in self.nacked:
+            self.fallback(routing, bodies)
+        self.nacked = []
+        if self.spool is not None:
+            self.spool.close()
+        super(RabbitmqHandler, self).close()
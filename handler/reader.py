@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+Read logs back from the table written by MySQLHandler.
+Rows are streamed by keyset pagination on id (WHERE id > last id ORDER BY id LIMIT n) with server-side cursors,
+so memory doesn't grow with the number of rows and pages don't slow down like OFFSET.
+
+run: python -m handler.reader --uri sqlite:///log.db --table log --min-level ERROR --since 2024-01-31 --format csv
+     python -m handler.reader --uri sqlite:///log.db --table log --tail
+"""
+
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+from datetime import datetime
+from sqlalchemy import create_engine, select, and_, or_, func, Table, MetaData
+from sqlalchemy.exc import NoSuchTableError
+from .utils import FMT_NAME, FMT_LEVELNO, FMT_LEVELNAME, FMT_CREATED
+from .mysql import PARTITION_FORMATS, LogTableError, list_partitions, partition_period
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_CSV = "csv"
+FORMATS = (FORMAT_NDJSON, FORMAT_CSV)
+
+
+class LogReader(object):
+    def __init__(self, uri: str, table_name: str, partition: str = None, batch_size: int = 1000):
+        """
+        Reader of log table of MySQLHandler.
+        :param uri: database uri
+        :param table_name: table name of MySQLHandler
+        :param partition: 'day' or 'month' if MySQLHandler writes partition tables, they are read in time order
+        :param batch_size: rows of one page, at most one page is fetched from database at once
+        """
+        if partition is not None and partition not in PARTITION_FORMATS:
+            raise LogTableError("partition should be one of {0}".format(list(PARTITION_FORMATS)))
+        self.engine = create_engine(uri, pool_recycle=6 * 3600)
+        self.table_name = table_name
+        self.partition = partition
+        self.batch_size = max(int(batch_size), 1)
+        self.tables = dict()     # table name: reflected Table
+        # (table name, id) of the last row read, pass it as after to continue reading
+        self.position = None
+
+    def get_table(self, name: str):
+        table = self.tables.get(name)
+        if table is None:
+            try:
+                table = Table(name, MetaData(), autoload=True, autoload_with=self.engine)
+            except NoSuchTableError:
+                raise LogTableError("log table {0} doesn't exist".format(name))
+            self.tables[name] = table
+        return table
+
+    def table_names(self, since: float = None, until: float = None):
+        """return names of log tables in time order, partitions out of [since, until) are skipped"""
+        if self.partition is None:
+            return [self.table_name]
+        suffixes = list_partitions(self.engine, self.table_name, self.partition)
+        if since is not None:
+            first = partition_period(self.partition, since)[2]
+            suffixes = [suffix for suffix in suffixes if suffix >= first]
+        if until is not None:
+            last = partition_period(self.partition, until)[2]
+            suffixes = [suffix for suffix in suffixes if suffix <= last]
+        return ["{0}_{1}".format(self.table_name, suffix) for suffix in suffixes]
+
+    @staticmethod
+    def get_column(table, field: str):
+        if field not in table.c:
+            raise LogTableError("log table {0} doesn't have column {1}".format(table.name, field))
+        return table.c[field]
+
+    @staticmethod
+    def cast(column, value):
+        """cast str value (eg: from command line) to python type of column"""
+        if not isinstance(value, str):
+            return value
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            return value
+        if python_type in (int, float):
+            return python_type(value)
+        if python_type is bool:
+            return value.lower() in ("1", "true", "yes")
+        return value
+
+    def build_conditions(self, table, levels: list = None, min_level=None, names: list = None, since: float = None,
+                         until: float = None, where: dict = None):
+        """
+        return list of conditions of select
+        :param levels: level names, eg: ["ERROR", "CRITICAL"]
+        :param min_level: lowest level, int or level name, compared by levelno column, or levelname if there isn't
+        :param names: logger names, child loggers are matched too, eg: "app" matches "app" and "app.db"
+        :param since: timestamp, rows with created >= since
+        :param until: timestamp, rows with created < until
+        :param where: column: value of columns, eg: new_field columns {"user": "bob"}
+        """
+        conditions = []
+        if levels:
+            conditions.append(self.get_column(table, FMT_LEVELNAME).in_(list(levels)))
+        if min_level is not None:
+            levelno = logging.getLevelName(min_level) if isinstance(min_level, str) else min_level
+            if not isinstance(levelno, int):
+                raise ValueError("unknown level {0}".format(min_level))
+            if FMT_LEVELNO in table.c:
+                conditions.append(table.c[FMT_LEVELNO] >= levelno)
+            else:
+                level_names = [logging.getLevelName(value) for value in range(levelno, logging.CRITICAL + 1)
+                               if not logging.getLevelName(value).startswith("Level ")]
+                conditions.append(self.get_column(table, FMT_LEVELNAME).in_(level_names))
+        if names:
+            column = self.get_column(table, FMT_NAME)
+            conditions.append(or_(*[or_(column == name, column.like(name + ".%")) for name in names]))
+        if since is not None:
+            conditions.append(self.get_column(table, FMT_CREATED) >= since)
+        if until is not None:
+            conditions.append(self.get_column(table, FMT_CREATED) < until)
+        for field, value in (where or {}).items():
+            column = self.get_column(table, field)
+            conditions.append(column == self.cast(column, value))
+        return conditions
+
+    def rows(self, levels: list = None, min_level=None, names: list = None, since: float = None, until: float = None,
+             where: dict = None, columns: list = None, after: tuple = None, limit: int = None):
+        """
+        generator of rows (dict) in id order, filters are the same as build_conditions
+        :param columns: columns of rows, default is all, 'id' is always contained
+        :param after: (table name, id) position, rows after it are read, eg: reader.position of last reading
+        :param limit: max rows
+        """
+        count = 0
+        for name in self.table_names(since, until):
+            if after is not None and name < after[0]:
+                continue
+            last_id = after[1] if after is not None and name == after[0] else 0
+            table = self.get_table(name)
+            conditions = self.build_conditions(table, levels, min_level, names, since, until, where)
+            selected = [table.c.id] + [self.get_column(table, field) for field in columns or [] if field != "id"]
+            while True:
+                page_size = self.batch_size if limit is None else min(self.batch_size, limit - count)
+                stmt = select(selected if columns else [table]).where(and_(table.c.id > last_id, *conditions)) \
+                    .order_by(table.c.id).limit(page_size)
+                fetched = 0
+                with self.engine.connect() as conn:
+                    for row in conn.execution_options(stream_results=True).execute(stmt):
+                        fetched += 1
+                        count += 1
+                        last_id = row["id"]
+                        self.position = (name, last_id)
+                        yield dict(row.items())
+                if limit is not None and count >= limit:
+                    return
+                if fetched < page_size:
+                    break
+
+    def end_position(self):
+        """return position of the last row, reading after it returns only new rows"""
+        names = self.table_names()
+        if not names:
+            return "", 0
+        table = self.get_table(names[-1])
+        with self.engine.connect() as conn:
+            return names[-1], conn.execute(select([func.max(table.c.id)])).scalar() or 0
+
+    def tail(self, poll_interval: float = 1.0, after: tuple = None, **filters):
+        """
+        generator of new rows, poll database every poll_interval seconds, never stops
+        :param after: position to start, default is the end of log table
+        :param filters: kwargs of rows
+        """
+        position = after if after is not None else self.end_position()
+        while True:
+            for row in self.rows(after=position, **filters):
+                yield row
+            if self.position is not None and self.position > position:
+                position = self.position
+            time.sleep(poll_interval)
+
+    def close(self):
+        self.engine.dispose()
+
+
+def _json_default(value):
+    return str(value)
+
+
+def write_ndjson(rows, f, flush: bool = False):
+    """write rows as NDJSON, return number of rows"""
+    count = 0
+    for row in rows:
+        f.write(json.dumps(row, ensure_ascii=False, default=_json_default) + "\n")
+        count += 1
+        if flush:
+            f.flush()
+    return count
+
+
+def write_csv(rows, f, flush: bool = False):
+    """write rows as CSV with header of the first row, JSON columns are written as JSON, return number of rows"""
+    writer = None
+    count = 0
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(f, fieldnames=list(row), extrasaction="ignore")
+            writer.writeheader()
+        writer.writerow({key: json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+                         for key, value in row.items()})
+        count += 1
+        if flush:
+            f.flush()
+    return count
+
+
+def parse_time(value: str):
+    """parse timestamp, or local time in ISO 8601 format, eg: 2024-01-31 or 2024-01-31T12:00:00"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def parse_where(items: list):
+    where = dict()
+    for item in items:
+        field, sep, value = item.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError("--where should be column=value, got {0}".format(item))
+        where[field] = value
+    return where
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m handler.reader", description="export logs of MySQLHandler")
+    parser.add_argument("--uri", required=True, help="database uri")
+    parser.add_argument("--table", required=True, help="table name of MySQLHandler")
+    parser.add_argument("--partition", choices=list(PARTITION_FORMATS), help="partition of MySQLHandler")
+    parser.add_argument("--level", nargs="*", help="level names, eg: ERROR CRITICAL")
+    parser.add_argument("--min-level", help="lowest level, eg: WARNING")
+    parser.add_argument("--name", nargs="*", help="logger names, child loggers are matched too")
+    parser.add_argument("--since", type=parse_time, help="timestamp or local time, eg: 2024-01-31T12:00:00")
+    parser.add_argument("--until", type=parse_time, help="timestamp or local time, exclusive")
+    parser.add_argument("--where", nargs="*", default=[], help="column=value, eg: user=bob")
+    parser.add_argument("--columns", nargs="*", help="columns of output, default is all")
+    parser.add_argument("--limit", type=int, help="max rows")
+    parser.add_argument("--format", choices=FORMATS, default=FORMAT_NDJSON)
+    parser.add_argument("--output", help="output file, default is stdout")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows of one page")
+    parser.add_argument("--tail", action="store_true", help="keep printing new rows")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between two polls of --tail")
+    args = parser.parse_args(argv)
+
+    reader = LogReader(args.uri, args.table, partition=args.partition, batch_size=args.batch_size)
+    filters = dict(levels=args.level, min_level=args.min_level, names=args.name, since=args.since, until=args.until,
+                   where=parse_where(args.where), columns=args.columns)
+    if args.tail:
+        rows = reader.tail(args.poll_interval, **filters)
+    else:
+        rows = reader.rows(limit=args.limit, **filters)
+    write = write_csv if args.format == FORMAT_CSV else write_ndjson
+    f = open(args.output, "w", newline="" if args.format == FORMAT_CSV else None) if args.output else sys.stdout
+    try:
+        write(rows, f, flush=args.tail)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if f is not sys.stdout:
+            f.close()
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
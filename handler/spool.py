@@ -0,0 +1,258 @@
+# -*- coding:utf-8 -*-
+
+"""
+Local disk spool of logs.
+When rabbitmq or database is unavailable, logs are appended to segment files and a replayer
+sends them in order after connection recovers.
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import threading
+from datetime import datetime
+from .utils import CircuitOpenError
+
+SEGMENT_SUFFIX = ".seg"
+CURSOR_NAME = "cursor"
+
+_FRAME_HEADER = struct.Struct(">II")    # payload length, crc32 of payload
+_ROUTING_HEADER = struct.Struct(">I")   # length of routing key
+
+
+def pack_message(routing_key: str, body: bytes):
+    """pack rabbitmq message into spool payload"""
+    routing_key = routing_key.encode("utf-8")
+    return _ROUTING_HEADER.pack(len(routing_key)) + routing_key + body
+
+
+def unpack_message(payload: bytes):
+    """unpack spool payload, return (routing_key, body)"""
+    size = _ROUTING_HEADER.unpack_from(payload)[0]
+    start = _ROUTING_HEADER.size
+    return payload[start:start + size].decode("utf-8"), payload[start + size:]
+
+
+def pack_row(row: dict):
+    """pack row of log table into spool payload"""
+    return json.dumps(row, ensure_ascii=False).encode("utf-8")
+
+
+def unpack_row(payload: bytes):
+    return json.loads(payload.decode("utf-8"))
+
+
+class DiskSpool(object):
+    def __init__(self, path: str, segment_size: int = 16 * 1024 * 1024, max_size: int = 1024 * 1024 * 1024,
+                 fsync_interval: float = 1.0):
+        """
+        Append-only spool made of segment files, consumed segments are deleted.
+        :param path: directory of segment files, spooled logs of last process are replayed too
+        :param segment_size: bytes of one segment file
+        :param max_size: max bytes of all segment files, new logs are dropped when spool is full
+        :param fsync_interval: seconds between two fsync of segment file
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.dropped = 0
+
+        self.segment_sizes = dict()
+        for name in os.listdir(path):
+            segment_id = name[:-len(SEGMENT_SUFFIX)]
+            if name.endswith(SEGMENT_SUFFIX) and segment_id.isdigit():
+                self.segment_sizes[int(segment_id)] = os.path.getsize(os.path.join(path, name))
+        self.read_segment, self.read_offset = self._load_cursor()
+        for segment_id in [s for s in self.segment_sizes if s < self.read_segment]:
+            self._remove_segment(segment_id)
+        if self.segment_sizes and min(self.segment_sizes) > self.read_segment:
+            # segment of cursor is consumed and deleted, read the next one from its start
+            self.read_segment, self.read_offset = min(self.segment_sizes), 0
+        elif not self.segment_sizes:
+            self.read_offset = 0
+        # never append to segment of last process, its tail may be broken
+        self.write_segment = max(list(self.segment_sizes) + [self.read_segment]) + 1
+        self.write_file = None
+        self.last_fsync = time.time()
+
+    @property
+    def size(self):
+        return sum(self.segment_sizes.values())
+
+    def _segment_path(self, segment_id: int):
+        return os.path.join(self.path, "{0:020d}{1}".format(segment_id, SEGMENT_SUFFIX))
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.path, CURSOR_NAME)) as f:
+                segment_id, offset = f.read().split()
+            return int(segment_id), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def _save_cursor(self):
+        cursor_path = os.path.join(self.path, CURSOR_NAME)
+        with open(cursor_path + ".tmp", "w") as f:
+            f.write("{0} {1}".format(self.read_segment, self.read_offset))
+        os.replace(cursor_path + ".tmp", cursor_path)
+
+    def _remove_segment(self, segment_id: int):
+        self.segment_sizes.pop(segment_id, None)
+        try:
+            os.remove(self._segment_path(segment_id))
+        except OSError:
+            pass
+
+    def _sync(self):
+        if self.write_file is not None:
+            self.write_file.flush()
+            os.fsync(self.write_file.fileno())
+        self.last_fsync = time.time()
+
+    def _roll(self):
+        """close full segment and start a new one"""
+        self._sync()
+        self.write_file.close()
+        self.write_file = None
+        self.write_segment += 1
+
+    def append(self, payload: bytes):
+        """append payload to spool, return False if spool is full and payload is dropped"""
+        frame = _FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            if self.size + len(frame) > self.max_size:
+                self.dropped += 1
+                return False
+            if self.write_file is None:
+                self.write_file = open(self._segment_path(self.write_segment), "ab")
+                self.segment_sizes[self.write_segment] = 0
+            self.write_file.write(frame)
+            self.segment_sizes[self.write_segment] += len(frame)
+            if self.segment_sizes[self.write_segment] >= self.segment_size:
+                self._roll()
+            elif time.time() - self.last_fsync >= self.fsync_interval:
+                self._sync()
+            self.not_empty.notify_all()
+        return True
+
+    def is_empty(self):
+        with self.lock:
+            return self._is_empty()
+
+    def _is_empty(self):
+        for segment_id, size in self.segment_sizes.items():
+            if segment_id > self.read_segment or (segment_id == self.read_segment and size > self.read_offset):
+                return False
+        return True
+
+    def wait(self, timeout: float = None):
+        """wait until spool isn't empty, return whether spool isn't empty"""
+        with self.lock:
+            return self.not_empty.wait_for(lambda: not self._is_empty(), timeout=timeout)
+
+    def read(self, max_count: int = 100):
+        """
+        read payloads in order without consuming them, call ack(position) after they are sent.
+        return (payloads, position)
+        """
+        payloads = []
+        with self.lock:
+            if self.write_file is not None:
+                self.write_file.flush()
+            segment_id, offset = self.read_segment, self.read_offset
+            while len(payloads) < max_count:
+                later = [s for s in self.segment_sizes if s > segment_id]
+                if offset >= self.segment_sizes.get(segment_id, 0):
+                    if not later:
+                        break
+                    segment_id, offset = min(later), 0
+                    continue
+                with open(self._segment_path(segment_id), "rb") as f:
+                    f.seek(offset)
+                    while len(payloads) < max_count:
+                        header = f.read(_FRAME_HEADER.size)
+                        if len(header) < _FRAME_HEADER.size:
+                            break
+                        size, crc = _FRAME_HEADER.unpack(header)
+                        payload = f.read(size)
+                        if len(payload) < size or zlib.crc32(payload) != crc:
+                            break
+                        payloads.append(payload)
+                        offset += _FRAME_HEADER.size + size
+                if len(payloads) < max_count and offset < self.segment_sizes.get(segment_id, 0):
+                    if segment_id == self.write_segment:
+                        break
+                    offset = self.segment_sizes[segment_id]  # skip broken tail of segment
+        return payloads, (segment_id, offset)
+
+    def ack(self, position: tuple):
+        """mark payloads before position as consumed"""
+        with self.lock:
+            segment_id, offset = position
+            for consumed in [s for s in self.segment_sizes if s < segment_id]:
+                self._remove_segment(consumed)
+            if segment_id != self.write_segment and offset >= self.segment_sizes.get(segment_id, 0):
+                self._remove_segment(segment_id)
+            self.read_segment, self.read_offset = segment_id, offset
+            self._save_cursor()
+
+    def close(self):
+        with self.lock:
+            if self.write_file is not None:
+                self._sync()
+                self.write_file.close()
+                self.write_file = None
+
+
+class SpoolReplayer(threading.Thread):
+    def __init__(self, spool: DiskSpool, send, batch_size: int = 100, retry_interval: float = 1.0,
+                 max_retry_interval: float = 30.0, name: str = "SpoolReplayer"):
+        """
+        Background thread sends spooled logs in order.
+        :param spool: DiskSpool
+        :param send: function(payloads), raise exception if payloads aren't sent, raise CircuitOpenError
+        to wait without backoff
+        :param batch_size: max payloads sent by one call of send
+        :param retry_interval: seconds to wait after send failed, doubled after every failure
+        :param max_retry_interval: max seconds to wait after send failed
+        """
+        super(SpoolReplayer, self).__init__(name=name, daemon=True)
+        self.spool = spool
+        self.send = send
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        interval = self.retry_interval
+        while not self.stopped.is_set():
+            payloads, position = self.spool.read(self.batch_size)
+            if not payloads:
+                self.spool.wait(timeout=1)
+                continue
+            try:
+                self.send(payloads)
+            except CircuitOpenError:
+                self.stopped.wait(self.retry_interval)
+                continue
+            except Exception as e:
+                msg = "{0} - [spool] Replay {1} logs failed: {2}\n".format(
+                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"), len(payloads), e)
+                sys.stdout.write(msg)
+                self.stopped.wait(interval)
+                interval = min(interval * 2, self.max_retry_interval)
+                continue
+            self.spool.ack(position)
+            interval = self.retry_interval
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
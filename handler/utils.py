@@ -1,5 +1,25 @@
 # -*- coding:utf-8 -*-
 
+import json
+import time
+import bisect
+import hashlib
+import random
+import logging
+import threading
+import traceback
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 FMT_NAME = "name"
 FMT_LEVELNO = "levelno"
 FMT_LEVELNAME = "levelname"
@@ -17,6 +37,12 @@ FMT_THREADNAME = "threadName"
 FMT_PROCESS = "process"
 FMT_PROCESSNAME = "processName"
 FMT_MESSAGE = "message"
+FMT_REPEAT_COUNT = "repeat_count"
+FMT_EXC_TYPE = "exc_type"
+FMT_EXC_MESSAGE = "exc_message"
+FMT_EXC_FINGERPRINT = "exc_fingerprint"
+FMT_EXC_TRACEBACK = "exc_traceback"
+FMT_EXC_COUNT = "exc_count"
 
 
 # logging定义的日志原始字段
@@ -37,9 +63,18 @@ LOGGING_FORMAT_NAME = (
     FMT_THREADNAME,         # 线程名称
     FMT_PROCESS,            # 进程ID
     FMT_PROCESSNAME,        # 进程名称
-    FMT_MESSAGE
+    FMT_MESSAGE,
+    FMT_REPEAT_COUNT,       # DedupFilter合并的重复日志条数
+    FMT_EXC_TYPE,           # 异常类型, eg: builtins.ZeroDivisionError
+    FMT_EXC_MESSAGE,        # 异常信息
+    FMT_EXC_FINGERPRINT,    # 异常指纹, 由异常类型和各栈帧的代码位置计算
+    FMT_EXC_TRACEBACK,      # 格式化的异常栈
+    FMT_EXC_COUNT,          # ExceptionDedupFilter窗口内同一指纹的出现次数
 )
 
+# 异常字段
+EXCEPTION_FIELDS = (FMT_EXC_TYPE, FMT_EXC_MESSAGE, FMT_EXC_FINGERPRINT, FMT_EXC_TRACEBACK, FMT_EXC_COUNT)
+
 
 DEFAULT_FORMAT = [
     FMT_NAME,
@@ -55,6 +90,13 @@ DEFAULT_FORMAT = [
 DEFAULT_EXCHANGE = "python.topic.logging"
 
 
+# 队列满时的处理策略
+OVERFLOW_BLOCK = "block"                # 阻塞直到队列有空位
+OVERFLOW_DROP_OLDEST = "drop_oldest"    # 丢弃队列中最早的日志
+OVERFLOW_DROP_NEWEST = "drop_newest"    # 丢弃当前日志
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
+
+
 # logging origin fields mapper
 LOGGING_FORMAT_MAPPER = {
     FMT_NAME: "String(50)",
@@ -73,12 +115,384 @@ LOGGING_FORMAT_MAPPER = {
     FMT_THREADNAME: "String(100)",
     FMT_PROCESS: "Integer",
     FMT_PROCESSNAME: "String(100)",
+    FMT_REPEAT_COUNT: "Integer",
+    FMT_EXC_TYPE: "String(200)",
+    FMT_EXC_MESSAGE: "String(1000)",
+    FMT_EXC_FINGERPRINT: "String(40)",
+    FMT_EXC_TRACEBACK: "Text",
+    FMT_EXC_COUNT: "Integer",
     # FMT_MESSAGE: "String(500)"
 }
 
 
+# 日志序列化方式
+SERIALIZER_JSON = "json"
+SERIALIZER_ORJSON = "orjson"
+SERIALIZER_MSGPACK = "msgpack"
+SERIALIZERS = (SERIALIZER_JSON, SERIALIZER_ORJSON, SERIALIZER_MSGPACK)
+
+# asctime时间格式
+DEFAULT_DATEFMT = "%Y-%m-%d %H:%M:%S"
+DATEFMT_ISO8601 = "iso8601"             # eg: 2019-11-01T12:30:00.123+08:00
+
+# 熔断器状态
+BREAKER_CLOSED = "closed"           # 正常发送
+BREAKER_OPEN = "open"               # 快速失败，等待探测
+BREAKER_HALF_OPEN = "half_open"     # 允许一次探测
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_MSGPACK = "application/msgpack"
+
+
 class LogOriginFieldError(Exception):
     def __init__(self, msg=None):
         if msg is None:
             msg = "logging origin field error."
         super(LogOriginFieldError, self).__init__(msg)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, msg=None):
+        if msg is None:
+            msg = "circuit breaker is open"
+        super(CircuitOpenError, self).__init__(msg)
+
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False)
+
+
+def _json_dumps(data):
+    return _json_encoder.encode(data).encode("utf-8")
+
+
+def _orjson_dumps(data):
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _msgpack_dumps(data):
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def get_serializer(name: str = None):
+    """
+    get serializer by name, return (dumps, content_type), dumps serializes log data to bytes.
+    :param name: 'json', 'orjson' or 'msgpack'. If name is None, use orjson when it is installed, otherwise json.
+    """
+    if name is None:
+        name = SERIALIZER_ORJSON if orjson is not None else SERIALIZER_JSON
+    if name == SERIALIZER_JSON:
+        return _json_dumps, CONTENT_TYPE_JSON
+    elif name == SERIALIZER_ORJSON:
+        if orjson is None:
+            raise ImportError("serializer orjson requires package orjson")
+        return _orjson_dumps, CONTENT_TYPE_JSON
+    elif name == SERIALIZER_MSGPACK:
+        if msgpack is None:
+            raise ImportError("serializer msgpack requires package msgpack")
+        return _msgpack_dumps, CONTENT_TYPE_MSGPACK
+    raise ValueError("serializer should be one of {0}".format(SERIALIZERS))
+
+
+class AsctimeFormatter(object):
+    def __init__(self, datefmt: str = DEFAULT_DATEFMT, msecs: bool = False):
+        """
+        Format timestamp of log record, formatted second is cached, so strftime is called once per second.
+        :param datefmt: time.strftime format, or 'iso8601'
+        :param msecs: whether append milliseconds, eg: 2019-11-01 12:30:00.123
+        """
+        self.datefmt = datefmt
+        self.msecs = msecs
+        self.is_iso8601 = datefmt == DATEFMT_ISO8601
+        # (second, formatted second, timezone suffix), replaced as a whole so it is thread-safe without lock
+        self._cache = (None, "", "")
+
+    def _format_second(self, second: int):
+        local = time.localtime(second)
+        if self.is_iso8601:
+            offset = time.strftime("%z", local)
+            return time.strftime("%Y-%m-%dT%H:%M:%S", local), offset[:3] + ":" + offset[3:]
+        return time.strftime(self.datefmt, local), ""
+
+    def format(self, created: float):
+        second = int(created)
+        cache = self._cache
+        if cache[0] != second:
+            cache = (second,) + self._format_second(second)
+            self._cache = cache
+        if self.msecs:
+            return "%s.%03d%s" % (cache[1], (created - second) * 1000, cache[2])
+        return cache[1] + cache[2]
+
+
+DEFAULT_ASCTIME_FORMATTER = AsctimeFormatter()
+
+
+def get_asctime_formatter(datefmt: str = None, msecs: bool = False):
+    """handlers with default format share one AsctimeFormatter, so share its cache"""
+    if (datefmt is None or datefmt == DEFAULT_DATEFMT) and not msecs:
+        return DEFAULT_ASCTIME_FORMATTER
+    return AsctimeFormatter(datefmt or DEFAULT_DATEFMT, msecs)
+
+
+def _get_message(record):
+    return record.msg
+
+
+_exception_formatter = logging.Formatter()
+
+
+def get_exc_info(record):
+    """return exc_info tuple of record, or None if record has no exception"""
+    exc_info = record.__dict__.get("exc_info")
+    if not exc_info or exc_info[0] is None:
+        return None
+    return exc_info
+
+
+def format_exception(exc_info):
+    """traceback text of exc_info, the same as logging.Formatter"""
+    return _exception_formatter.formatException(exc_info)
+
+
+def exception_type(exc_info):
+    return "{0}.{1}".format(exc_info[0].__module__, exc_info[0].__qualname__)
+
+
+def exception_message(exc_info, max_length: int = 1000):
+    """str of exception, truncated to max_length, which is the length of column exc_message"""
+    return str(exc_info[1])[:max_length]
+
+
+def exception_fingerprint(exc_info):
+    """
+    stable fingerprint of exception, sha1 of exception type and code locations (module, function, line) of frames.
+    It doesn't depend on exception message or file paths, so it is the same across processes and hosts.
+    """
+    digest = hashlib.sha1(exception_type(exc_info).encode("utf-8"))
+    for frame, lineno in traceback.walk_tb(exc_info[2]):
+        code = frame.f_code
+        digest.update("|{0}:{1}:{2}".format(frame.f_globals.get("__name__"), code.co_name, lineno).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _get_exc_type(record):
+    exc_info = get_exc_info(record)
+    return exception_type(exc_info) if exc_info is not None else None
+
+
+def _get_exc_message(record):
+    exc_info = get_exc_info(record)
+    return exception_message(exc_info) if exc_info is not None else None
+
+
+def _get_exc_fingerprint(record):
+    exc_info = get_exc_info(record)
+    return exception_fingerprint(exc_info) if exc_info is not None else None
+
+
+def _get_exc_traceback(record):
+    exc_text = record.__dict__.get("exc_text")
+    if exc_text:
+        return exc_text
+    exc_info = get_exc_info(record)
+    return format_exception(exc_info) if exc_info is not None else None
+
+
+# exception fields computed from exc_info, unless ExceptionDedupFilter has set them on record
+_EXCEPTION_GETTERS = {
+    FMT_EXC_TYPE: _get_exc_type,
+    FMT_EXC_MESSAGE: _get_exc_message,
+    FMT_EXC_FINGERPRINT: _get_exc_fingerprint,
+    FMT_EXC_TRACEBACK: _get_exc_traceback,
+}
+
+
+def _exception_getter(field, compute):
+    def getter(record):
+        attrs = record.__dict__
+        return attrs[field] if field in attrs else compute(record)
+    return getter
+
+
+class RecordProjector(object):
+    def __init__(self, fields, asctime_formatter: AsctimeFormatter = None):
+        """
+        Read only the given format fields from log record, without copying record.__dict__
+        :param fields: format string fields of defined by logging, 'asctime' is formatted from 'created'
+        and 'message' is the original msg of record
+        :param asctime_formatter: formatter of 'asctime', default is DEFAULT_ASCTIME_FORMATTER
+        """
+        self.fields = tuple(fields)
+        self.asctime_formatter = asctime_formatter or DEFAULT_ASCTIME_FORMATTER
+        getters = []
+        for field in self.fields:
+            if field == FMT_ASCTIME:
+                getters.append((field, lambda record, fmt=self.asctime_formatter.format: fmt(record.created)))
+            elif field == FMT_MESSAGE:
+                getters.append((field, _get_message))
+            elif field in _EXCEPTION_GETTERS:
+                getters.append((field, _exception_getter(field, _EXCEPTION_GETTERS[field])))
+            else:
+                getters.append((field, None))  # read from record.__dict__
+        self.getters = tuple(getters)
+
+    def project(self, record):
+        """return dict of fields"""
+        attrs = record.__dict__
+        return {field: attrs.get(field) if getter is None else getter(record) for field, getter in self.getters}
+
+    def values(self, record):
+        """return tuple of fields value"""
+        attrs = record.__dict__
+        return tuple(attrs.get(field) if getter is None else getter(record) for field, getter in self.getters)
+
+
+class RoutingKeyPlanner(object):
+    def __init__(self, appname: str, routing_key: list, cache_size: int = 1024,
+                 asctime_formatter: AsctimeFormatter = None):
+        """
+        Compile fields list of routing key once, eg: ["name", "levelname", "message.field"]
+        :param appname: application name, first part of routing key
+        :param routing_key: fields list of routing key, fields of message should use dot separate
+        :param cache_size: max routing keys cached when routing_key only contains logging format fields
+        :param asctime_formatter: formatter of 'asctime' field
+        """
+        self.appname = appname
+        self.prefix = appname + "."
+        self.paths = tuple(tuple(field.split(".")) for field in routing_key)
+        self.fallback = appname + ".*" * len(self.paths)
+        self.fields = None
+        if all(len(path) == 1 and path[0] in LOGGING_FORMAT_NAME for path in self.paths):
+            # routing key only depends on record attributes, such as name and levelname
+            self.fields = tuple(path[0] for path in self.paths)
+            self.join_values = lru_cache(maxsize=cache_size)(self.join_values)
+            self.projector = RecordProjector(self.fields, asctime_formatter)
+        else:
+            top_fields = []
+            for path in self.paths:
+                if path[0] not in top_fields:
+                    top_fields.append(path[0])
+            self.projector = RecordProjector(top_fields, asctime_formatter)
+
+    @staticmethod
+    def resolve(data: dict, path: tuple):
+        value = None
+        last = len(path) - 1
+        for index, key in enumerate(path):
+            value = data.get(key)
+            data = value
+            if not isinstance(data, dict):
+                if index == last and value is not None:
+                    value = str(value)
+                break
+        return value if isinstance(value, str) else "*"
+
+    def join_values(self, values: tuple):
+        routing = self.prefix + ".".join(
+            "*" if value is None or isinstance(value, dict) else str(value) for value in values
+        )
+        if len(self.appname) < 255 < len(routing):
+            routing = self.fallback
+        if len(routing) > 255:
+            routing = routing[:255]
+        return routing
+
+    def get_routing_key(self, data: dict):
+        """get routing key of log data, eg: appname.loggername.INFO"""
+        if self.fields is not None:
+            try:
+                return self.join_values(tuple(data.get(field) for field in self.fields))
+            except TypeError:  # unhashable value
+                pass
+        return self.join_values(tuple(self.resolve(data, path) for path in self.paths))
+
+    def get_record_routing_key(self, record):
+        """get routing key of log record, only fields of routing key are read from record"""
+        if self.fields is not None:
+            try:
+                return self.join_values(self.projector.values(record))
+            except TypeError:
+                pass
+        return self.get_routing_key(self.projector.project(record))
+
+
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold: int = 3, probe_interval: float = 1.0, max_probe_interval: float = 60.0,
+                 jitter: float = 0.2):
+        """
+        Circuit breaker of connection to rabbitmq or database.
+        After failure_threshold continuous failures the circuit opens and requests fail fast, after probe
+        interval one request is allowed to probe (half open). If the probe fails, circuit opens again and
+        the interval is doubled until max_probe_interval.
+        :param failure_threshold: continuous failures to open circuit
+        :param probe_interval: seconds between opening circuit and the first probe
+        :param max_probe_interval: max seconds between two probes
+        :param jitter: random ratio added to interval, so that processes don't probe at the same time
+        """
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.jitter = jitter
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.open_count = 0
+        self.next_probe = 0
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        """return whether request should be sent"""
+        if self.state == BREAKER_CLOSED:
+            return True
+        with self.lock:
+            if self.state == BREAKER_OPEN and time.time() >= self.next_probe:
+                self.state = BREAKER_HALF_OPEN
+                return True
+            return self.state == BREAKER_CLOSED
+
+    def record_success(self):
+        if self.state == BREAKER_CLOSED and self.failures == 0:
+            return
+        with self.lock:
+            self.state = BREAKER_CLOSED
+            self.failures = 0
+            self.open_count = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == BREAKER_HALF_OPEN or self.failures >= self.failure_threshold:
+                interval = min(self.probe_interval * 2 ** min(self.open_count, 32), self.max_probe_interval)
+                interval *= 1 + random.uniform(-self.jitter, self.jitter)
+                self.state = BREAKER_OPEN
+                self.open_count += 1
+                self.next_probe = time.time() + interval
+
+
+class ConsistentHashRing(object):
+    def __init__(self, size: int, replicas: int = 100, cache_size: int = 4096):
+        """
+        Consistent hash of keys to nodes 0...size-1, every node has replicas points on the ring.
+        md5 is used instead of hash(), so a key is mapped to the same node in every process.
+        :param size: number of nodes
+        :param replicas: points of one node on the ring, more points spread keys more evenly
+        :param cache_size: size of lru cache of get
+        """
+        self.size = max(int(size), 1)
+        points = sorted(
+            (self.hash("{0}-{1}".format(node, replica)), node)
+            for node in range(self.size) for replica in range(replicas)
+        )
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+        self.get = lru_cache(maxsize=cache_size)(self.get)
+
+    @staticmethod
+    def hash(key: str):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def get(self, key: str):
+        """return node of key"""
+        if self.size == 1:
+            return 0
+        index = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.nodes[index]
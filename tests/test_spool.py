@@ -0,0 +1,35 @@
+# -*- coding:utf-8 -*-
+
+import shutil
+import tempfile
+import unittest
+from handler.spool import DiskSpool
+
+
+class DiskSpoolRestartTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_records_after_consumed_segment_survive_restart(self):
+        spool = DiskSpool(self.path, segment_size=64)
+        for index in range(10):
+            spool.append("old {0}".format(index).encode("utf-8"))
+        payloads, position = spool.read(10)
+        self.assertEqual(len(payloads), 10)
+        spool.ack(position)
+        for index in range(3):
+            spool.append("new {0}".format(index).encode("utf-8"))
+        spool.close()
+
+        spool = DiskSpool(self.path, segment_size=64)
+        self.assertFalse(spool.is_empty())
+        payloads, _ = spool.read(10)
+        self.assertEqual(payloads, [b"new 0", b"new 1", b"new 2"])
+        spool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()